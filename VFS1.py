@@ -7,13 +7,25 @@ class VFS:
     self.disk_1 = [bytearray(100) for i in range(200)]
     self.disk_2 = [bytearray(100) for i in range(300)]
     self.block_metadata = [BlockInfo() for i in range(500)]
+    self.tracer = None
+
+  def set_tracer(self, tracer):
+    # Error messages go to 'tracer' as 'message' events instead of being
+    # printed, see tracing.py. None prints them again.
+    self.tracer = tracer
+
+  def _log(self, message):
+    if self.tracer is None:
+      print(message)
+    else:
+      self.tracer.message(message)
 
   def write_block(self, block_no, block_info):
     if block_no > 500 or block_no < 1:
-      print ("Invalid block no")
+      self._log("Invalid block no")
       return
     if len(block_info) > 100:
-      print ("Block data too big")
+      self._log("Block data too big")
       return
     metadata = self.block_metadata[block_no-1]
     metadata.size = len(block_info)
@@ -26,7 +38,7 @@ class VFS:
 
   def read_block(self, block_no, block_info):
     if block_no > 500 or block_no < 1:
-      print ("Invalid block no")
+      self._log("Invalid block no")
       return
     metadata = self.block_metadata[block_no-1]
     assert not metadata.free
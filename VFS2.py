@@ -27,13 +27,25 @@ class VFS:
     self.disk_2 = [bytearray(100) for i in range(300)]
     self.block_metadata = [BlockInfo() for i in range(500)]
     self.disk_metadata = {}
+    self.tracer = None
+
+  def set_tracer(self, tracer):
+    # Error messages go to 'tracer' as 'message' events instead of being
+    # printed, see tracing.py. None prints them again.
+    self.tracer = tracer
+
+  def _log(self, message):
+    if self.tracer is None:
+      print(message)
+    else:
+      self.tracer.message(message)
 
   def _write_block(self, block_no, block_info):
     if block_no > 500 or block_no < 1:
-      print("Invalid block no")
+      self._log("Invalid block no")
       return False
     if len(block_info) > 100:
-      print("Block data too big")
+      self._log("Block data too big")
       return False
     metadata = self.block_metadata[block_no-1]
     metadata.size = len(block_info)
@@ -47,7 +59,7 @@ class VFS:
 
   def _read_block(self, block_no, block_info):
     if block_no > 500 or block_no < 1:
-      print("Invalid block no")
+      self._log("Invalid block no")
       return -1
     metadata = self.block_metadata[block_no-1]
     if metadata.free:
@@ -63,10 +75,10 @@ class VFS:
   def create_disk(self, id, size):
     # Check if disk of given id exists
     if id in self.disk_metadata:
-      print('A disk with given id exists')
+      self._log('A disk with given id exists')
       return False
     if size > 500:
-      print('Out of memory!')
+      self._log('Out of memory!')
       return False
     # find contigous space of 'size' blocks. O(n^2), could be optimized.
     start = -1
@@ -76,7 +88,7 @@ class VFS:
         break
     # print('sdasdasaddasds', start, start+size)
     if start < 0:
-      print('Out of memory!')
+      self._log('Out of memory!')
       return False
     for bid in range(start, start+size):
       block_data = self.block_metadata[bid]
@@ -91,7 +103,7 @@ class VFS:
 
   def delete_disk(self, id):
     if not id in self.disk_metadata:
-      print('No disk with given id found!')
+      self._log('No disk with given id found!')
       return False
     metadata = self.disk_metadata[id]
     for bid in metadata.disk_blocks():
@@ -110,22 +122,22 @@ class VFS:
 
   def write_block(self, id, block_no, block_info):
     if not id in self.disk_metadata:
-      print('Invalid disk id')
+      self._log('Invalid disk id')
       return False
     metadata = self.disk_metadata[id]
     if block_no>metadata.size or block_no < 1:
-      print('Invalid block no')
+      self._log('Invalid block no')
       return False
     pid = metadata.disk_blocks()[block_no-1]
     return self._write_block(pid+1, block_info)
 
   def read_block(self, id, block_no, block_info):  
     if not id in self.disk_metadata:
-      print('Invalid disk id')
+      self._log('Invalid disk id')
       return -1
     metadata = self.disk_metadata[id]
     if block_no > metadata.size or block_no < 1:
-      print('Invalid block no')
+      self._log('Invalid block no')
       return False
     pid = metadata.disk_blocks()[block_no-1]
     return self._read_block(pid+1, block_info)
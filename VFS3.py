@@ -1,8 +1,17 @@
 """
 Supports creation/deletion of virtual disks. Disks are allocated blocks
-from a list of free block ids.
+from a bitmap of free blocks and record them as extents, runs of
+consecutive physical blocks on one backing disk.
+With locality=True the allocator keeps a disk on as few, as large runs as
+possible, so sequential reads are served by a few slice copies.
 """
-from collections import deque
+import os
+import tempfile
+import time
+from bisect import bisect_right
+from bitmap import Bitmap
+from metrics import Metrics
+from tracing import FileTracer, RingTracer, read_trace, replay
 
 class BlockInfo:
   def __init__(self):
@@ -16,82 +25,419 @@ class BlockInfo:
 
 class DiskInfo:
   def __init__(self):
-    self.blocks = []
+    # (start, length) runs of physical block ids, and the logical block
+    # (0-based) each run starts at.
+    self.extents = []
+    self.starts = []
+    self.size = 0
+
+  def add_extent(self, start, length):
+    # Extents never span both backing disks, a run over the boundary is
+    # split in two.
+    if start < 200 < start+length:
+      self.add_extent(start, 200-start)
+      self.add_extent(200, start+length-200)
+      return
+    if self.extents:
+      last_start, last_length = self.extents[-1]
+      if last_start + last_length == start and start != 200:
+        self.extents[-1] = (last_start, last_length + length)
+        self.size += length
+        return
+    self.extents.append((start, length))
+    self.starts.append(self.size)
+    self.size += length
+
+  def block_id(self, block_no):
+    i = bisect_right(self.starts, block_no-1) - 1
+    return self.extents[i][0] + block_no-1 - self.starts[i]
+
   def disk_blocks(self):
-    return self.blocks
+    return [bid for (start, length) in self.extents
+                for bid in range(start, start+length)]
 
 class VFS:
-  def __init__(self):
-    self.disk_1 = [bytearray(100) for i in range(200)]
-    self.disk_2 = [bytearray(100) for i in range(300)]
+  def __init__(self, locality=False):
+    # Each backing disk is one flat buffer, block i of it starts at i*100.
+    self.disk_1 = bytearray(100*200)
+    self.disk_2 = bytearray(100*300)
     self.block_metadata = [BlockInfo() for i in range(500)]
     self.disk_metadata = {}
-    self.free_blocks = deque([i for i in range(500)])
+    self.free_blocks = Bitmap(500)
+    self.metrics = None
+    self.tracer = None
+    self.locality = locality
+
+  def _block_location(self, block_no):
+    if block_no <= 200:
+      return (self.disk_1, (block_no-1)*100)
+    return (self.disk_2, (block_no-201)*100)
 
   def _write_block(self, block_no, block_info):
     if block_no > 500 or block_no < 1:
-      print("Invalid block no")
+      self._log("Invalid block no")
       return False
     if len(block_info) > 100:
-      print("Block data too big")
+      self._log("Block data too big")
       return False
     metadata = self.block_metadata[block_no-1]
     metadata.size = len(block_info)
     metadata.free = False
-    if block_no <= 200:
-      block = self.disk_1[block_no-1]
-    else:
-      block = self.disk_2[block_no-201]
-    block[:len(block_info)] = block_info
+    block, offset = self._block_location(block_no)
+    block[offset:offset+len(block_info)] = block_info
+    if self.metrics is not None:
+      self.metrics.record_device(block_no, 'write', len(block_info))
     return True
 
   def _read_block(self, block_no, block_info):
     if block_no > 500 or block_no < 1:
-      print("Invalid block no")
+      self._log("Invalid block no")
       return -1
     metadata = self.block_metadata[block_no-1]
     if metadata.free:
       return 0
-    if block_no <= 200:
-      block = self.disk_1[block_no-1]
-    else:
-      block = self.disk_2[block_no-201]
+    block, offset = self._block_location(block_no)
     res_size = min(len(block_info), metadata.size)
-    block_info[:res_size] = block[:res_size]
+    block_info[:res_size] = block[offset:offset+res_size]
+    if self.metrics is not None:
+      self.metrics.record_device(block_no, 'read', res_size)
     return res_size
 
+  def _read_run(self, block_no, block_infos):
+    # Reads len(block_infos) consecutive physical blocks starting at
+    # block_no, with one slice copy per backing disk touched. Returns the
+    # sizes read.
+    sizes = []
+    while len(sizes) < len(block_infos):
+      bno = block_no + len(sizes)
+      n = len(block_infos) - len(sizes)
+      if bno <= 200:
+        n = min(n, 201-bno)
+      block, offset = self._block_location(bno)
+      data = block[offset:offset+n*100]
+      for i in range(n):
+        metadata = self.block_metadata[bno-1+i]
+        block_info = block_infos[len(sizes)]
+        size = 0 if metadata.free else min(len(block_info), metadata.size)
+        block_info[:size] = data[i*100:i*100+size]
+        sizes.append(size)
+      if self.metrics is not None:
+        self.metrics.record_device(bno, 'read', n*100)
+    return sizes
+
+  def _write_run(self, block_no, block_infos):
+    # Writes len(block_infos) consecutive physical blocks starting at
+    # block_no, with one slice copy per backing disk touched. Returns
+    # True/False per block.
+    if block_no < 1 or block_no+len(block_infos)-1 > 500:
+      self._log("Invalid block no")
+      return [False]*len(block_infos)
+    res = []
+    while len(res) < len(block_infos):
+      bno = block_no + len(res)
+      n = len(block_infos) - len(res)
+      if bno <= 200:
+        n = min(n, 201-bno)
+      block, offset = self._block_location(bno)
+      data = block[offset:offset+n*100]
+      nbytes = 0
+      for i in range(n):
+        block_info = block_infos[len(res)]
+        if len(block_info) > 100:
+          self._log("Block data too big")
+          res.append(False)
+          continue
+        metadata = self.block_metadata[bno-1+i]
+        metadata.size = len(block_info)
+        metadata.free = False
+        data[i*100:i*100+len(block_info)] = block_info
+        nbytes += len(block_info)
+        res.append(True)
+      block[offset:offset+n*100] = data
+      if self.metrics is not None:
+        self.metrics.record_device(bno, 'write', nbytes)
+    return res
+
+  def _free_extents(self):
+    # Free runs split at the boundary between the backing disks.
+    return self._split_extents(self.free_blocks.free_runs())
+
+  def _split_extents(self, runs):
+    extents = []
+    for (start, length) in runs:
+      if start < 200 < start+length:
+        extents.append((start, 200-start))
+        extents.append((200, start+length-200))
+      else:
+        extents.append((start, length))
+    return extents
+
+  def _plan_extents(self, size, free=None):
+    # Picks 'size' blocks out of the free extents 'free' (by default the
+    # current free space). Each extent returned starts at the start of a
+    # free extent.
+    if size <= 0:
+      return []
+    if free is None:
+      free = self._free_extents()
+    if not self.locality:
+      # First fit: lowest free blocks in address order.
+      chosen = free
+    else:
+      fits = [e for e in free if e[1] >= size]
+      if fits:
+        # Best fit, leaves the larger runs for larger disks.
+        return [(min(fits, key=lambda e: e[1])[0], size)]
+      # Stay on one backing disk if it has room, taking its largest runs.
+      on_disk_1 = [e for e in free if e[0] < 200]
+      on_disk_2 = [e for e in free if e[0] >= 200]
+      chosen = free
+      for candidates in sorted([on_disk_1, on_disk_2],
+                               key=lambda c: -sum(e[1] for e in c)):
+        if sum(e[1] for e in candidates) >= size:
+          chosen = candidates
+          break
+      chosen = sorted(chosen, key=lambda e: -e[1])
+    extents = []
+    for (start, length) in chosen:
+      if size == 0:
+        break
+      length = min(length, size)
+      extents.append((start, length))
+      size -= length
+    return extents
+
+  def enable_metrics(self, metrics=None):
+    # Starts recording into 'metrics' (a new Metrics if not given) and
+    # returns it. Set self.metrics to None to stop.
+    if metrics is None:
+      metrics = Metrics()
+    self.metrics = metrics
+    return metrics
+
+  def _log(self, message):
+    # Error and status messages go to the tracer when one is set.
+    if self.tracer is None:
+      print(message)
+    else:
+      self.tracer.message(message)
+
+  def set_tracer(self, tracer):
+    # Emits an event per API call to 'tracer', see tracing.py. None stops
+    # tracing.
+    self.tracer = tracer
+
+  def _physical_block(self, id, block_no):
+    metadata = self.disk_metadata.get(id)
+    if metadata is None or block_no > metadata.size or block_no < 1:
+      return -1
+    return metadata.block_id(block_no)
+
   def create_disk(self, id, size):
+    if self.metrics is None and self.tracer is None:
+      return self._create_disk(id, size)
+    start = time.perf_counter()
+    res = self._create_disk(id, size)
+    duration = time.perf_counter() - start
+    if self.metrics is not None:
+      self.metrics.record_op('create_disk', id, 0, res, duration)
+    if self.tracer is not None:
+      self.tracer.emit('create_disk', id, -1, -1, size, res, duration)
+    return res
+
+  def _create_disk(self, id, size):
     # Check if disk of given id exists
     if id in self.disk_metadata:
-      print('A disk with given id exists')
+      self._log('A disk with given id exists')
       return False
-    if size > len(self.free_blocks):
-      print('Out of memory!')
+    if size > self.free_blocks.free_count():
+      self._log('Out of memory!')
       return False
-    # Allocate the first 'size' blocks from free blocks list.
     metadata = DiskInfo()
-    while size > 0:
-      bid = self.free_blocks.popleft()
-      block_data = self.block_metadata[bid]
-      block_data.unallocated = False
-      block_data.disk_id = id
-      metadata.blocks.append(bid)
-      size -= 1
+    for (start, length) in self._plan_extents(size):
+      self.free_blocks.set_range(start, length)
+      for bid in range(start, start+length):
+        block_data = self.block_metadata[bid]
+        block_data.unallocated = False
+        block_data.disk_id = id
+      metadata.add_extent(start, length)
 
     self.disk_metadata[id] = metadata
     return True
 
   def delete_disk(self, id):
+    if self.tracer is None:
+      return self._delete_disk(id)
+    start = time.perf_counter()
+    res = self._delete_disk(id)
+    self.tracer.emit('delete_disk', id, -1, -1, 0, res,
+                     time.perf_counter() - start)
+    return res
+
+  def _delete_disk(self, id):
     if not id in self.disk_metadata:
-      print('No disk with given id found!')
+      self._log('No disk with given id found!')
       return False
     metadata = self.disk_metadata[id]
-    for bid in metadata.disk_blocks():
-      self.free_blocks.append(bid)
-      self.block_metadata[bid].reset()
+    for (start, length) in metadata.extents:
+      self.free_blocks.clear_range(start, length)
+      for bid in range(start, start+length):
+        self.block_metadata[bid].reset()
+      # Wipe the data so read_blocks never hands it to the next owner.
+      block, offset = self._block_location(start+1)
+      block[offset:offset+length*100] = bytes(length*100)
     self.disk_metadata.pop(id)
     return True
 
+  def transaction(self, ops):
+    if self.metrics is None and self.tracer is None:
+      return self._transaction(ops)
+    start = time.perf_counter()
+    res = self._transaction(ops)
+    # Recorded as the individual operations, each with an equal share of
+    # the time. A failed transaction changed nothing and is not traced.
+    duration = (time.perf_counter() - start)/max(len(ops), 1)
+    names = {'create': 'create_disk', 'delete': 'delete_disk',
+             'resize': 'resize_disk'}
+    for op in ops:
+      name = names.get(op[0], op[0])
+      size = op[2] if len(op) > 2 else 0
+      if self.metrics is not None:
+        self.metrics.record_op(name, op[1], 0, res, duration)
+      if self.tracer is not None and res:
+        self.tracer.emit(name, op[1], -1, -1, size, res, duration)
+    return res
+
+  def _transaction(self, ops):
+    """
+    Applies a list of ('create', id, size), ('delete', id) and
+    ('resize', id, size) operations all-or-nothing. Operations see the
+    effect of the ones before them. Allocation for the whole batch is
+    planned in one pass over a single snapshot of the free extents, and
+    nothing is changed unless every operation can be carried out.
+    Resizing keeps the data of the blocks that remain.
+    """
+    free = sorted(self._free_extents())
+    # Planned extents of every disk the batch touches, None once deleted.
+    planned = {}
+    # Blocks given up by a disk during the batch. Their data is wiped even
+    # if the same disk claims them again later in the batch.
+    released = set()
+    merge = False
+    for op in ops:
+      kind, id = op[0], op[1]
+      if id in planned:
+        extents = planned[id]
+      elif id in self.disk_metadata:
+        extents = list(self.disk_metadata[id].extents)
+      else:
+        extents = None
+      if kind == 'delete':
+        if extents is None:
+          self._log('No disk with given id found!')
+          return False
+        free.extend(extents)
+        for (start, length) in extents:
+          released.update(range(start, start+length))
+        merge = True
+        planned[id] = None
+        continue
+      if kind not in ('create', 'resize') or len(op) != 3 or op[2] < 0:
+        self._log('Invalid operation %r' % (op,))
+        return False
+      size = op[2]
+      if kind == 'create' and extents is not None:
+        self._log('A disk with given id exists')
+        return False
+      if kind == 'resize' and extents is None:
+        self._log('No disk with given id found!')
+        return False
+      if extents is None:
+        extents = []
+      current = sum(length for (start, length) in extents)
+      if size < current:
+        # Shrink from the end of the disk.
+        while current > size:
+          start, length = extents.pop()
+          cut = min(length, current - size)
+          if cut < length:
+            extents.append((start, length - cut))
+          free.append((start + length - cut, cut))
+          released.update(range(start + length - cut, start + length))
+          current -= cut
+        merge = True
+      elif size > current:
+        if merge:
+          free = self._merge_extents(free)
+          merge = False
+        if size - current > sum(length for (start, length) in free):
+          self._log('Out of memory!')
+          return False
+        taken = self._plan_extents(size - current, free)
+        extents += taken
+        taken = dict(taken)
+        free = [(start + taken.get(start, 0), length - taken.get(start, 0))
+                for (start, length) in free
+                if length > taken.get(start, 0)]
+      planned[id] = extents
+
+    # Everything is valid, apply it. Blocks leaving a disk are released
+    # before blocks joining one are claimed, a block may do both.
+    claimed = []
+    for id, extents in planned.items():
+      new_blocks = set()
+      if extents is not None:
+        new_blocks = set(bid for (start, length) in extents
+                             for bid in range(start, start+length))
+      old = self.disk_metadata.get(id)
+      old_blocks = set()
+      if old is not None:
+        old_blocks = set(old.disk_blocks())
+        kept = (old_blocks & new_blocks) - released
+        for bid in old_blocks - kept:
+          self.free_blocks.clear(bid)
+          self.block_metadata[bid].reset()
+          block, offset = self._block_location(bid+1)
+          block[offset:offset+100] = bytes(100)
+        old_blocks = kept
+      claimed.append((id, extents, new_blocks - old_blocks))
+    for (id, extents, blocks) in claimed:
+      if extents is None:
+        self.disk_metadata.pop(id, None)
+        continue
+      for bid in blocks:
+        self.free_blocks.set(bid)
+        block_data = self.block_metadata[bid]
+        block_data.unallocated = False
+        block_data.disk_id = id
+      metadata = DiskInfo()
+      for (start, length) in extents:
+        metadata.add_extent(start, length)
+      self.disk_metadata[id] = metadata
+    return True
+
+  def _merge_extents(self, extents):
+    merged = []
+    for (start, length) in sorted(extents):
+      if merged and sum(merged[-1]) == start:
+        merged[-1] = (merged[-1][0], merged[-1][1] + length)
+      else:
+        merged.append((start, length))
+    return self._split_extents(merged)
+
+  def resize_disk(self, id, size):
+    return self.transaction([('resize', id, size)])
+
+  def allocation_stats(self):
+    # largest_free_run() is cached, fragmentation() reuses it.
+    return {'free': self.free_blocks.free_count(),
+            'largest_free_run': self.free_blocks.largest_free_run(),
+            'fragmentation': self.free_blocks.fragmentation()}
+
+  def allocation_map(self):
+    # Run-length encoded allocation map, see Bitmap.runs().
+    return self.free_blocks.runs()
+
   def print_block_allocation(self):
     for bid in range(0, 500):
       metadata = self.block_metadata[bid]
@@ -102,27 +448,86 @@ class VFS:
     print('')
 
   def write_block(self, id, block_no, block_info):
+    if self.metrics is None and self.tracer is None:
+      return self._write_disk_block(id, block_no, block_info)
+    start = time.perf_counter()
+    res = self._write_disk_block(id, block_no, block_info)
+    duration = time.perf_counter() - start
+    if self.metrics is not None:
+      self.metrics.record_op('write', id, len(block_info) if res else 0, res,
+                             duration)
+    if self.tracer is not None:
+      self.tracer.emit('write', id, block_no, self._physical_block(id, block_no),
+                       len(block_info), res, duration)
+    return res
+
+  def _write_disk_block(self, id, block_no, block_info):
     if not id in self.disk_metadata:
-      print('Invalid disk id')
+      self._log('Invalid disk id')
       return False
     metadata = self.disk_metadata[id]
-    if block_no > len(metadata.disk_blocks()) or block_no < 1:
-      print('Invalid block no')
+    if block_no > metadata.size or block_no < 1:
+      self._log('Invalid block no')
       return False
-    pid = metadata.disk_blocks()[block_no-1]
+    pid = metadata.block_id(block_no)
     return self._write_block(pid+1, block_info)
 
-  def read_block(self, id, block_no, block_info):  
+  def read_block(self, id, block_no, block_info):
+    if self.metrics is None and self.tracer is None:
+      return self._read_disk_block(id, block_no, block_info)
+    start = time.perf_counter()
+    res = self._read_disk_block(id, block_no, block_info)
+    duration = time.perf_counter() - start
+    ok = res is not False and res >= 0
+    if self.metrics is not None:
+      self.metrics.record_op('read', id, res if ok else 0, ok, duration)
+    if self.tracer is not None:
+      self.tracer.emit('read', id, block_no, self._physical_block(id, block_no),
+                       len(block_info), res, duration)
+    return res
+
+  def _read_disk_block(self, id, block_no, block_info):
     if not id in self.disk_metadata:
-      print('Invalid disk id')
+      self._log('Invalid disk id')
       return -1
     metadata = self.disk_metadata[id]
-    if block_no>len(metadata.disk_blocks()) or block_no < 1:
-      print('Invalid block no')
+    if block_no > metadata.size or block_no < 1:
+      self._log('Invalid block no')
       return False
-    pid = metadata.disk_blocks()[block_no-1]
+    pid = metadata.block_id(block_no)
     return self._read_block(pid+1, block_info)
 
+  def read_blocks(self, id, block_no, count, block_info):
+    # Reads 'count' blocks starting at 'block_no' into block_info, block i
+    # at offset i*100. Each extent is copied with a single slice. Returns
+    # the list of block sizes.
+    if not id in self.disk_metadata:
+      self._log('Invalid disk id')
+      return -1
+    metadata = self.disk_metadata[id]
+    if block_no < 1 or count < 0 or block_no+count-1 > metadata.size:
+      self._log('Invalid block no')
+      return -1
+    if len(block_info) < count*100:
+      self._log('Buffer too small')
+      return -1
+    sizes = []
+    i = bisect_right(metadata.starts, block_no-1) - 1
+    dst = 0
+    while len(sizes) < count:
+      start, length = metadata.extents[i]
+      skip = block_no-1 + len(sizes) - metadata.starts[i]
+      n = min(length-skip, count-len(sizes))
+      block, offset = self._block_location(start+skip+1)
+      block_info[dst:dst+n*100] = block[offset:offset+n*100]
+      if self.metrics is not None:
+        self.metrics.record_device(start+skip+1, 'read', n*100)
+      for bid in range(start+skip, start+skip+n):
+        sizes.append(self.block_metadata[bid].size)
+      dst += n*100
+      i += 1
+    return sizes
+
 
 def test_disk_api():
   vfs = VFS()
@@ -139,6 +544,8 @@ def test_disk_api():
   print('Deleting Disk C')
   vfs.delete_disk('C')
   vfs.print_block_allocation()
+  print('Allocation stats:', vfs.allocation_stats())
+  print('Allocation map:', vfs.allocation_map())
   print('Creating Disk A of size 300 blocks')
   vfs.create_disk('A', 300) # Should be successful now.
   vfs.print_block_allocation()
@@ -186,6 +593,96 @@ def test_block_api():
   print('Reading rbuff1 from block 2 in Disk B')
   vfs.read_block('B',2, rbuff1)
 
+def test_locality():
+  for locality in (False, True):
+    print('Testing allocation with locality =', locality)
+    vfs = VFS(locality)
+    for (id, size) in [('A', 50), ('B', 100), ('C', 50), ('D', 150), ('E', 100)]:
+      vfs.create_disk(id, size)
+    print('Deleting Disks A, C and E')
+    vfs.delete_disk('A')
+    vfs.delete_disk('C')
+    vfs.delete_disk('E')
+    print('Creating Disk F of size 60 blocks')
+    vfs.create_disk('F', 60)
+    print('Creating Disk G of size 120 blocks')
+    vfs.create_disk('G', 120)
+    vfs.print_block_allocation()
+    print('Extents of F:', vfs.disk_metadata['F'].extents)
+    print('Extents of G:', vfs.disk_metadata['G'].extents)
+    for i in range(1, 121):
+      vfs.write_block('G', i, bytearray(('g' + str(i)).encode()))
+    block_info = bytearray(120*100)
+    sizes = vfs.read_blocks('G', 1, 120, block_info)
+    print('Block 1 and 120 of G:', block_info[:sizes[0]].decode('utf-8'),
+          block_info[119*100:119*100+sizes[119]].decode('utf-8'))
+
+def test_boundary():
+  print('Testing a disk crossing from disk_1 to disk_2')
+  vfs = VFS()
+  vfs.create_disk('A', 150)
+  vfs.create_disk('B', 100)
+  print('Extents of B:', vfs.disk_metadata['B'].extents)
+  for i in range(1, 101):
+    vfs.write_block('B', i, bytearray(('b' + str(i)).encode()))
+  block_info = bytearray(100*100)
+  sizes = vfs.read_blocks('B', 1, 100, block_info)
+  ok = all(block_info[i*100:i*100+sizes[i]].decode('utf-8') == 'b' + str(i+1)
+           for i in range(100))
+  print('Read back all blocks of B:', ok, len(block_info))
+  vfs.delete_disk('B')
+  print('Backing disks after deleting B:', len(vfs.disk_1), len(vfs.disk_2))
+
+def test_tracing():
+  print('Recording a workload on Disk A and B')
+  vfs = VFS()
+  path = os.path.join(tempfile.mkdtemp(), 'vfs.trace')
+  with FileTracer(path) as tracer:
+    vfs.set_tracer(tracer)
+    vfs.create_disk('A', 10)
+    vfs.create_disk('B', 10)
+    for i in range(1, 11):
+      vfs.write_block('A', i, bytearray(b'a'*i))
+      vfs.read_block('B', i, bytearray(100))
+    vfs.read_block('A', 11, bytearray(100))
+    vfs.delete_disk('B')
+  events = list(read_trace(path))
+  os.remove(path)
+  os.rmdir(os.path.dirname(path))
+  for event in events[:4] + events[-3:]:
+    print(event.op, event.disk_id, event.block_no, event.pid, event.size,
+          event.result, event.message)
+  print('Replaying', len(events), 'events with locality allocation')
+  vfs = VFS(locality=True)
+  ring = RingTracer()
+  vfs.set_tracer(ring)
+  count, elapsed = replay(vfs, events)
+  print('Replayed', count, 'events, traced', len(ring.events))
+
+def test_transaction():
+  vfs = VFS(locality=True)
+  vfs.create_disk('A', 100)
+  vfs.create_disk('B', 100)
+  vfs.write_block('A', 1, bytearray(b'kept'))
+  print('Replacing Disk B by C and D, growing Disk A in one transaction')
+  vfs.transaction([('delete', 'B'), ('create', 'C', 150),
+                   ('create', 'D', 50), ('resize', 'A', 120)])
+  vfs.print_block_allocation()
+  block_info = bytearray(10)
+  sz = vfs.read_block('A', 1, block_info)
+  print('Block 1 of Disk A:', block_info[:sz].decode('utf-8'))
+  print('A transaction running out of space changes nothing')
+  before = vfs.allocation_map()
+  print(vfs.transaction([('delete', 'D'), ('create', 'E', 400)]))
+  print('Unchanged:', before == vfs.allocation_map(), 'D' in vfs.disk_metadata)
+  print('Shrinking Disk C to 10 blocks')
+  vfs.resize_disk('C', 10)
+  print(vfs.allocation_stats())
+
 if __name__ == '__main__':
   test_disk_api()
   test_block_api()
+  test_locality()
+  test_boundary()
+  test_tracing()
+  test_transaction()
@@ -1,9 +1,15 @@
 """
 Supports replication of blocks.
+write_blocks() writes a batch of blocks with the primary and replica
+writes fanned out to one writer thread per physical disk.
 Supports creation/deletion of virtual disks. Disks are allocated blocks
-from a list of free block ids.
+from a bitmap of free blocks.
 """
-from collections import deque
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from bitmap import Bitmap
+from metrics import Metrics
 import random
 
 generate_read_errors = True
@@ -35,22 +41,35 @@ class VFS:
     self.disk_2 = [bytearray(100) for i in range(300)]
     self.block_metadata = [BlockInfo() for i in range(500)]
     self.disk_metadata = {}
-    self.free_blocks = deque([i for i in range(500)])
+    self.free_blocks = Bitmap(500)
+    self.metrics = None
+    self.tracer = None
     self.original_read_error = 0;
     self.replica_read_error = 0;
     self.read_error = False;
-
+    # One single-threaded writer per physical disk, so writes to the same
+    # block are applied in submission order.
+    self.writers = None
+    # Replica jobs not acknowledged yet, and the number of writes left in
+    # them, see write_blocks().
+    self.catch_up = set()
+    self.catch_up_writes = 0
+    self.catch_up_lock = threading.Lock()
 
   def _write_block(self, block_no, block_info):
     if block_no > 500 or block_no < 1:
-      print("Invalid block no")
+      self._log("Invalid block no")
       return False
     if len(block_info) > 100:
-      print("Block data too big")
+      self._log("Block data too big")
       return False
     metadata = self.block_metadata[block_no-1]
     if metadata.error:
-      print ("Corrupted block write at block ", block_no )
+      self._log('Corrupted block write at block %d' % block_no)
+      if self.metrics is not None:
+        self.metrics.inc('device_errors_total',
+                         device='disk_1' if block_no <= 200 else 'disk_2',
+                         op='write')
       return -1
     metadata.size = len(block_info)
     metadata.free = False
@@ -59,6 +78,8 @@ class VFS:
     else:
       block = self.disk_2[block_no-201]
     block[:len(block_info)] = block_info
+    if self.metrics is not None:
+      self.metrics.record_device(block_no, 'write', len(block_info))
     return True
 
   def _read_block(self, block_no, block_info):
@@ -66,14 +87,22 @@ class VFS:
     # if block_no == 1:
     #   return -1
     if block_no > 500 or block_no < 1:
-      print("Invalid block no")
+      self._log("Invalid block no")
       return -1
     metadata = self.block_metadata[block_no-1]
     if metadata.error:
-      print("Corrupted block read from block ", block_no)
+      self._log('Corrupted block read from block %d' % block_no)
+      if self.metrics is not None:
+        self.metrics.inc('device_errors_total',
+                         device='disk_1' if block_no <= 200 else 'disk_2',
+                         op='read')
       return -1
     if generate_read_errors and random.random() < read_error_prob:
-      print ("Random read error")
+      self._log("Random read error")
+      if self.metrics is not None:
+        self.metrics.inc('device_errors_total',
+                         device='disk_1' if block_no <= 200 else 'disk_2',
+                         op='read')
       self.read_error = True;
       return -1
     if metadata.free:
@@ -84,42 +113,101 @@ class VFS:
       block = self.disk_2[block_no-201]
     res_size = min(len(block_info), metadata.size)
     block_info[:res_size] = block[:res_size]
+    if self.metrics is not None:
+      self.metrics.record_device(block_no, 'read', res_size)
     return res_size
 
+  def enable_metrics(self, metrics=None):
+    # Starts recording into 'metrics' (a new Metrics if not given) and
+    # returns it. Set self.metrics to None to stop.
+    if metrics is None:
+      metrics = Metrics()
+    self.metrics = metrics
+    return metrics
+
+  def _log(self, message):
+    # Error and status messages go to the tracer when one is set.
+    if self.tracer is None:
+      print(message)
+    else:
+      self.tracer.message(message)
+
+  def set_tracer(self, tracer):
+    # Emits an event per API call to 'tracer', see tracing.py. None stops
+    # tracing.
+    self.tracer = tracer
+
+  def _physical_block(self, id, block_no):
+    metadata = self.disk_metadata.get(id)
+    if metadata is None or block_no > metadata.size or block_no < 1:
+      return -1
+    return metadata.disk_blocks()[block_no-1]
+
   def create_disk(self, id, size):
+    if self.metrics is None and self.tracer is None:
+      return self._create_disk(id, size)
+    start = time.perf_counter()
+    res = self._create_disk(id, size)
+    duration = time.perf_counter() - start
+    if self.metrics is not None:
+      self.metrics.record_op('create_disk', id, 0, res, duration)
+    if self.tracer is not None:
+      self.tracer.emit('create_disk', id, -1, -1, size, res, duration)
+    return res
+
+  def _create_disk(self, id, size):
     # Check if disk of given id exists
     if id in self.disk_metadata:
-      print('A disk with given id exists')
+      self._log('A disk with given id exists')
       return False
     size = 2*size
-    if size > len(self.free_blocks):
-      print('Out of memory!')
+    if size > self.free_blocks.free_count():
+      self._log('Out of memory!')
       return False
-    # Allocate the first 'size' blocks from free blocks list.
+    # Allocate the lowest 'size' free blocks.
     metadata = DiskInfo()
     metadata.size = size//2
-    while size > 0:
-      bid = self.free_blocks.popleft()
+    for bid in self.free_blocks.allocate(size):
       block_data = self.block_metadata[bid]
       block_data.unallocated = False
       block_data.disk_id = id
       metadata.blocks.append(bid)
-      size -= 1
 
     self.disk_metadata[id] = metadata
     return True
 
   def delete_disk(self, id):
+    if self.tracer is None:
+      return self._delete_disk(id)
+    start = time.perf_counter()
+    res = self._delete_disk(id)
+    self.tracer.emit('delete_disk', id, -1, -1, 0, res,
+                     time.perf_counter() - start)
+    return res
+
+  def _delete_disk(self, id):
+    if self.catch_up:
+      self.flush()
     if not id in self.disk_metadata:
-      print('No disk with given id found!')
+      self._log('No disk with given id found!')
       return False
     metadata = self.disk_metadata[id]
     for bid in metadata.disk_blocks():
-      self.free_blocks.append(bid)
+      self.free_blocks.clear(bid)
       self.block_metadata[bid].reset()
     self.disk_metadata.pop(id)
     return True
 
+  def allocation_stats(self):
+    # largest_free_run() is cached, fragmentation() reuses it.
+    return {'free': self.free_blocks.free_count(),
+            'largest_free_run': self.free_blocks.largest_free_run(),
+            'fragmentation': self.free_blocks.fragmentation()}
+
+  def allocation_map(self):
+    # Run-length encoded allocation map, see Bitmap.runs().
+    return self.free_blocks.runs()
+
   def print_block_allocation(self):
     for bid in range(0, 500):
       metadata = self.block_metadata[bid]
@@ -140,12 +228,28 @@ class VFS:
     return -1
     
   def write_block(self, id, block_no, block_info):
+    if self.metrics is None and self.tracer is None:
+      return self._write_disk_block(id, block_no, block_info)
+    start = time.perf_counter()
+    res = self._write_disk_block(id, block_no, block_info)
+    duration = time.perf_counter() - start
+    if self.metrics is not None:
+      self.metrics.record_op('write', id, len(block_info) if res else 0, res,
+                             duration)
+    if self.tracer is not None:
+      self.tracer.emit('write', id, block_no, self._physical_block(id, block_no),
+                       len(block_info), res, duration)
+    return res
+
+  def _write_disk_block(self, id, block_no, block_info):
+    if self.catch_up:
+      self.flush()
     if not id in self.disk_metadata:
-      print('Invalid disk id')
+      self._log('Invalid disk id')
       return False
     metadata = self.disk_metadata[id]
     if block_no > metadata.size or block_no < 1:
-      print('Invalid block no')
+      self._log('Invalid block no')
       return False
     pid = metadata.disk_blocks()[block_no-1]
     if not self._write_block(pid+1, block_info):
@@ -155,20 +259,169 @@ class VFS:
       # assign a block for replication.
       rpid = self.find_free_block(id)
       if rpid < 0:
-        print ("Not enough space for replication!")
+        self._log("Not enough space for replication!")
         return True
       block_data.replication = rpid
     if not self._write_block(block_data.replication+1, block_info):
-      print('Failed to create replica')
+      self._log('Failed to create replica')
     return True
 
-  def read_block(self, id, block_no, block_info):  
+  def _writer(self, device):
+    if self.writers is None:
+      self.writers = (ThreadPoolExecutor(max_workers=1),
+                      ThreadPoolExecutor(max_workers=1))
+    return self.writers[device]
+
+  def _write_many(self, writes):
+    return [self._write_block(pid+1, data) for (pid, data) in writes]
+
+  def _catch_up_many(self, writes):
+    results = []
+    for (pid, data) in writes:
+      results.append(self._write_block(pid+1, data))
+      with self.catch_up_lock:
+        self.catch_up_writes -= 1
+    return results
+
+  def write_blocks(self, id, blocks, ack='all'):
+    if self.metrics is None and self.tracer is None:
+      return self._write_blocks(id, blocks, ack)
+    start = time.perf_counter()
+    res = self._write_blocks(id, blocks, ack)
+    # Recorded as one write per block, each with an equal share of the
+    # time.
+    duration = (time.perf_counter() - start)/max(len(blocks), 1)
+    for (block_no, block_info), ok in zip(blocks, res):
+      if self.metrics is not None:
+        self.metrics.record_op('write', id, len(block_info) if ok else 0, ok,
+                               duration)
+      if self.tracer is not None:
+        self.tracer.emit('write', id, block_no,
+                         self._physical_block(id, block_no), len(block_info),
+                         ok, duration)
+    return res
+
+  def _write_blocks(self, id, blocks, ack='all'):
+    """
+    Writes a batch of (block_no, block_info) pairs to disk 'id'. Primary
+    and replica copies are handed to the writer thread of their physical
+    disk, one job per disk and copy. Replicas are written after their
+    primary succeeded. With ack='all' the call returns once
+    every copy is written. With ack='primary' it returns once the
+    primaries are written, and replica writes catch up in the background;
+    see pending_replicas() and flush(). With only two copies a majority
+    quorum is the same as 'all'. Returns a list with the result of each
+    write.
+    """
+    if ack not in ('all', 'primary'):
+      raise ValueError('ack must be all or primary')
     if not id in self.disk_metadata:
-      print('Invalid disk id')
+      self._log('Invalid disk id')
+      return [False]*len(blocks)
+    metadata = self.disk_metadata[id]
+    results = [False]*len(blocks)
+    # Per physical disk: indices into 'blocks' and (pid, data) writes.
+    indices = ([], [])
+    primaries = ([], [])
+    for i, (block_no, block_info) in enumerate(blocks):
+      if block_no > metadata.size or block_no < 1:
+        self._log('Invalid block no')
+        continue
+      if len(block_info) > 100:
+        self._log("Block data too big")
+        continue
+      # Copied, the caller may reuse the buffer before the replica is out.
+      data = bytes(block_info)
+      pid = metadata.disk_blocks()[block_no-1]
+      block_data = self.block_metadata[pid]
+      if block_data.replication is None:
+        rpid = self.find_free_block(id)
+        if rpid < 0:
+          self._log("Not enough space for replication!")
+        else:
+          # Reserve it, so the next block of the batch picks another one.
+          self.block_metadata[rpid].free = False
+          block_data.replication = rpid
+      device = 0 if pid < 200 else 1
+      indices[device].append(i)
+      primaries[device].append((pid, data))
+    primary_jobs = []
+    for device in (0, 1):
+      if primaries[device]:
+        primary_jobs.append((device, self._writer(device).submit(
+          self._write_many, primaries[device])))
+    wait([job for (device, job) in primary_jobs])
+    # A block whose primary write failed keeps its old replica, so a later
+    # failover never returns data reported as not written.
+    replicas = ([], [])
+    for (device, job) in primary_jobs:
+      for i, (pid, data), res in zip(indices[device], primaries[device],
+                                     job.result()):
+        results[i] = res is True
+        rpid = self.block_metadata[pid].replication
+        if res is True and rpid is not None:
+          replicas[0 if rpid < 200 else 1].append((rpid, data))
+    replica_jobs = []
+    write = self._write_many if ack == 'all' else self._catch_up_many
+    for device in (0, 1):
+      if replicas[device]:
+        if ack != 'all':
+          with self.catch_up_lock:
+            self.catch_up_writes += len(replicas[device])
+        replica_jobs.append(self._writer(device).submit(
+          write, replicas[device]))
+    if ack == 'all':
+      wait(replica_jobs)
+      self._check_replicas(replica_jobs)
+    else:
+      for job in replica_jobs:
+        self.catch_up.add(job)
+        job.add_done_callback(self.catch_up.discard)
+    return results
+
+  def _check_replicas(self, jobs):
+    for job in jobs:
+      if not all(res is True for res in job.result()):
+        self._log('Failed to create replica')
+
+  def pending_replicas(self):
+    # Replica writes still catching up.
+    return self.catch_up_writes
+
+  def flush(self):
+    # Waits for all replica writes still catching up.
+    futures = list(self.catch_up)
+    wait(futures)
+    self._check_replicas(futures)
+
+  def close(self):
+    self.flush()
+    if self.writers is not None:
+      for writer in self.writers:
+        writer.shutdown()
+      self.writers = None
+
+  def read_block(self, id, block_no, block_info):
+    if self.metrics is None and self.tracer is None:
+      return self._read_disk_block(id, block_no, block_info)
+    start = time.perf_counter()
+    res = self._read_disk_block(id, block_no, block_info)
+    duration = time.perf_counter() - start
+    ok = res is not False and res >= 0
+    if self.metrics is not None:
+      self.metrics.record_op('read', id, res if ok else 0, ok, duration)
+    if self.tracer is not None:
+      self.tracer.emit('read', id, block_no, self._physical_block(id, block_no),
+                       len(block_info), res, duration)
+    return res
+
+  def _read_disk_block(self, id, block_no, block_info):
+    if not id in self.disk_metadata:
+      self._log('Invalid disk id')
       return -1
     metadata = self.disk_metadata[id]
     if block_no > metadata.size or block_no < 1:
-      print('Invalid block no')
+      self._log('Invalid block no')
       return False
 
     pid = metadata.disk_blocks()[block_no-1]
@@ -179,29 +432,35 @@ class VFS:
         self. original_read_error += 1
         self.read_error = False;
       # try for the replication block
+      if self.catch_up:
+        self.flush()
       bdata = self.block_metadata[pid]
       bdata.error = True
       rpid = bdata.replication
       if rpid is None:
-        print("Error retrieving block")
+        self._log("Error retrieving block")
         return -1
       res = self._read_block(rpid+1, block_info)
       if res < 0:
         if(self.read_error):
           self.replica_read_error += 1
           self.read_error = False;
-        print("Error retrieving block")
+        self._log("Error retrieving block")
         self.block_metadata[rpid].error = True
         return -1
-      print('Block read from replica')
+      self._log('Block read from replica')
+      if self.metrics is not None:
+        self.metrics.inc('failovers_total', disk=id)
       # Make original block point towards the replica.
       metadata.disk_blocks()[block_no-1] = rpid
       new_rpid = self.find_free_block(id)
       if new_rpid < 0:
-        print("Error creating replica")
+        self._log("Error creating replica")
         return res
       if self._write_block(new_rpid+1, block_info):
         self.block_metadata[rpid].replication = new_rpid
+        if self.metrics is not None:
+          self.metrics.inc('repairs_total', disk=id)
       return res
     return res
 
@@ -247,7 +506,46 @@ def test_replication():
   print ("# original_read_error : " , vfs.original_read_error)
   print ("# replica read error : " ,vfs.replica_read_error)
 
+def test_metrics():
+  vfs = VFS()
+  metrics = vfs.enable_metrics()
+  vfs.create_disk('A', 100)
+  vfs.create_disk('B', 50)
+  for i in range(1, 51):
+    vfs.write_block('A', i, bytearray(b'block ' + str(i).encode()))
+    vfs.write_block('B', i, bytearray(b'data'))
+  b = bytearray(50)
+  for i in range(1, 51):
+    vfs.read_block('A', i, b)
+  print(metrics.snapshot()['histograms'])
+  print(metrics.export_prometheus())
 
+def test_write_blocks():
+  vfs = VFS()
+  vfs.create_disk('A', 100)
+  blocks = [(i, bytearray(('batched block ' + str(i)).encode()))
+            for i in range(1, 51)]
+  print('Writing 50 blocks in one batch, ack=all')
+  results = vfs.write_blocks('A', blocks)
+  print('All written:', all(results))
+  print('Rewriting them with ack=primary')
+  blocks = [(i, bytearray(('rewritten block ' + str(i)).encode()))
+            for i in range(1, 51)]
+  results = vfs.write_blocks('A', blocks, ack='primary')
+  print('Primaries written:', all(results), 'replicas pending:',
+        vfs.pending_replicas())
+  vfs.flush()
+  print('After flush, replicas pending:', vfs.pending_replicas())
+  global generate_read_errors
+  errors, generate_read_errors = generate_read_errors, False
+  b = bytearray(50)
+  pid = vfs.disk_metadata['A'].disk_blocks()[9]
+  sz = vfs._read_block(vfs.block_metadata[pid].replication+1, b)
+  print('Replica of block 10:', b[:sz].decode('utf-8'))
+  generate_read_errors = errors
+  vfs.close()
 
 if __name__ == '__main__':
   test_replication()
+  test_metrics()
+  test_write_blocks()
@@ -1,10 +1,15 @@
 """
-Supports snapshots.
+Supports snapshots and writable clones of snapshots.
+Snapshots share blocks with the disk they were taken from, a block shared
+by more than one disk or snapshot is copied on write.
 Supports creation/deletion of virtual disks. Disks are allocated blocks
-from a list of free block ids.
+from a bitmap of free blocks.
+With lazy=True block buffers and metadata are only built when a block is
+first used, so even very large volumes are constructed instantly.
 """
-from collections import deque
-import copy
+import time
+from bitmap import Bitmap
+from metrics import Metrics
 
 class BlockInfo:
   def __init__(self):
@@ -12,10 +17,36 @@ class BlockInfo:
     self.free = True
     self.unallocated = True
     self.disk_id = None
+    # Number of disks and snapshots referring to this block.
+    self.refs = 0
   
   def reset(self):
     self.__init__()
 
+class LazyList:
+  # Fixed size list whose items are built by 'factory' on first access.
+  def __init__(self, size, factory):
+    self.size = size
+    self.factory = factory
+    self.items = {}
+
+  def __len__(self):
+    return self.size
+
+  def __getitem__(self, i):
+    item = self.items.get(i)
+    if item is None:
+      if i < 0 or i >= self.size:
+        raise IndexError(i)
+      item = self.items[i] = self.factory()
+    return item
+
+  def __setitem__(self, i, item):
+    self.items[i] = item
+
+  def discard(self, i):
+    self.items.pop(i, None)
+
 class DiskInfo:
   def __init__(self):
     self.blocks = []
@@ -24,130 +55,312 @@ class DiskInfo:
     return self.blocks
 
 class VFS:
-  def __init__(self):
-    self.disk_1 = [bytearray(100) for i in range(200)]
-    self.disk_2 = [bytearray(100) for i in range(300)]
-    self.block_metadata = [BlockInfo() for i in range(500)]
+  def __init__(self, disk_1_blocks=200, disk_2_blocks=300, lazy=False):
+    self.disk_1_blocks = disk_1_blocks
+    self.num_blocks = disk_1_blocks + disk_2_blocks
+    self.lazy = lazy
+    if lazy:
+      self.disk_1 = LazyList(disk_1_blocks, lambda: bytearray(100))
+      self.disk_2 = LazyList(disk_2_blocks, lambda: bytearray(100))
+      self.block_metadata = LazyList(self.num_blocks, BlockInfo)
+    else:
+      self.disk_1 = [bytearray(100) for i in range(disk_1_blocks)]
+      self.disk_2 = [bytearray(100) for i in range(disk_2_blocks)]
+      self.block_metadata = [BlockInfo() for i in range(self.num_blocks)]
     self.disk_metadata = {}
-    self.free_blocks = deque([i for i in range(500)])
+    self.free_blocks = Bitmap(self.num_blocks, lazy)
+    self.metrics = None
+    self.tracer = None
 
   def _write_block(self, block_no, block_info):
-    if block_no > 500 or block_no < 1:
-      print("Invalid block no")
+    if block_no > self.num_blocks or block_no < 1:
+      self._log("Invalid block no")
       return False
     if len(block_info) > 100:
-      print("Block data too big")
+      self._log("Block data too big")
       return False
     metadata = self.block_metadata[block_no-1]
     metadata.size = len(block_info)
     metadata.free = False
-    if block_no <= 200:
+    if block_no <= self.disk_1_blocks:
       block = self.disk_1[block_no-1]
     else:
-      block = self.disk_2[block_no-201]
+      block = self.disk_2[block_no-self.disk_1_blocks-1]
     block[:len(block_info)] = block_info
+    if self.metrics is not None:
+      self.metrics.record_device(block_no, 'write', len(block_info),
+                                 self.disk_1_blocks)
     return True
 
   def _read_block(self, block_no, block_info):
-    if block_no > 500 or block_no < 1:
-      print("Invalid block no")
+    if block_no > self.num_blocks or block_no < 1:
+      self._log("Invalid block no")
       return -1
     metadata = self.block_metadata[block_no-1]
     if metadata.free:
       return 0
-    if block_no <= 200:
+    if block_no <= self.disk_1_blocks:
       block = self.disk_1[block_no-1]
     else:
-      block = self.disk_2[block_no-201]
+      block = self.disk_2[block_no-self.disk_1_blocks-1]
     res_size = min(len(block_info), metadata.size)
     block_info[:res_size] = block[:res_size]
+    if self.metrics is not None:
+      self.metrics.record_device(block_no, 'read', res_size,
+                                 self.disk_1_blocks)
     return res_size
 
+  def enable_metrics(self, metrics=None):
+    # Starts recording into 'metrics' (a new Metrics if not given) and
+    # returns it. Set self.metrics to None to stop.
+    if metrics is None:
+      metrics = Metrics()
+    self.metrics = metrics
+    return metrics
+
+  def _log(self, message):
+    # Error and status messages go to the tracer when one is set.
+    if self.tracer is None:
+      print(message)
+    else:
+      self.tracer.message(message)
+
+  def set_tracer(self, tracer):
+    # Emits an event per API call to 'tracer', see tracing.py. None stops
+    # tracing.
+    self.tracer = tracer
+
+  def _physical_block(self, id, block_no):
+    metadata = self.disk_metadata.get(id)
+    if metadata is None or block_no < 1:
+      return -1
+    if block_no > len(metadata.disk_blocks()):
+      return -1
+    return metadata.disk_blocks()[block_no-1]
+
   def create_disk(self, id, size):
+    if self.metrics is None and self.tracer is None:
+      return self._create_disk(id, size)
+    start = time.perf_counter()
+    res = self._create_disk(id, size)
+    duration = time.perf_counter() - start
+    if self.metrics is not None:
+      self.metrics.record_op('create_disk', id, 0, res, duration)
+    if self.tracer is not None:
+      self.tracer.emit('create_disk', id, -1, -1, size, res, duration)
+    return res
+
+  def _create_disk(self, id, size):
     # Check if disk of given id exists
     if id in self.disk_metadata:
-      print('A disk with given id exists')
+      self._log('A disk with given id exists')
       return False
-    if size > len(self.free_blocks):
-      print('Out of memory!')
+    if size > self.free_blocks.free_count():
+      self._log('Out of memory!')
       return False
-    # Allocate the first 'size' blocks from free blocks list.
+    # Allocate the lowest 'size' free blocks.
     metadata = DiskInfo()
-    while size > 0:
-      bid = self.free_blocks.popleft()
+    for bid in self.free_blocks.allocate(size):
       block_data = self.block_metadata[bid]
       block_data.unallocated = False
       block_data.disk_id = id
+      block_data.refs = 1
       metadata.blocks.append(bid)
-      size -= 1
 
     self.disk_metadata[id] = metadata
     return True
 
   def delete_disk(self, id):
+    if self.tracer is None:
+      return self._delete_disk(id)
+    start = time.perf_counter()
+    res = self._delete_disk(id)
+    self.tracer.emit('delete_disk', id, -1, -1, 0, res,
+                     time.perf_counter() - start)
+    return res
+
+  def _delete_disk(self, id):
     if not id in self.disk_metadata:
-      print('No disk with given id found!')
+      self._log('No disk with given id found!')
       return False
     metadata = self.disk_metadata[id]
     for bid in metadata.disk_blocks():
-      self.free_blocks.append(bid)
-      self.block_metadata[bid].reset()
+      self._release_block(bid)
+    for snapshot in metadata.snapshots:
+      for bid in snapshot:
+        self._release_block(bid)
     self.disk_metadata.pop(id)
     return True
 
+  def _release_block(self, bid):
+    block_data = self.block_metadata[bid]
+    block_data.refs -= 1
+    if block_data.refs == 0:
+      block_data.reset()
+      self.free_blocks.clear(bid)
+      if self.lazy:
+        # Back to the implicit all-default state, memory follows use.
+        self.block_metadata.discard(bid)
+        if bid < self.disk_1_blocks:
+          self.disk_1.discard(bid)
+        else:
+          self.disk_2.discard(bid-self.disk_1_blocks)
+
+  def _own_block(self, id, block_no):
+    # Returns a physical block that only disk 'id' refers to, copying
+    # the mapping of a shared block on write. Whole blocks are always
+    # rewritten, so the old data does not have to be copied.
+    blocks = self.disk_metadata[id].disk_blocks()
+    pid = blocks[block_no-1]
+    if self.block_metadata[pid].refs == 1:
+      return pid
+    if self.free_blocks.free_count() == 0:
+      self._log('Out of memory!')
+      return -1
+    new_pid = self.free_blocks.allocate(1)[0]
+    block_data = self.block_metadata[new_pid]
+    block_data.unallocated = False
+    block_data.disk_id = id
+    block_data.refs = 1
+    self._release_block(pid)
+    blocks[block_no-1] = new_pid
+    return new_pid
+
+  def allocation_stats(self):
+    # largest_free_run() is cached, fragmentation() reuses it.
+    return {'free': self.free_blocks.free_count(),
+            'largest_free_run': self.free_blocks.largest_free_run(),
+            'fragmentation': self.free_blocks.fragmentation()}
+
+  def allocation_map(self):
+    # Run-length encoded allocation map, see Bitmap.runs().
+    return self.free_blocks.runs()
+
   def print_block_allocation(self):
-    for bid in range(0, 500):
-      metadata = self.block_metadata[bid]
-      if metadata.unallocated:
+    for bid in range(0, self.num_blocks):
+      # Allocated blocks are exactly the ones set in the bitmap, checking
+      # it first keeps untouched blocks of a lazy volume unmaterialized.
+      if not self.free_blocks.test(bid):
         print('__', end=' ')
       else:
-        print(metadata.disk_id, end=' ')
+        print(self.block_metadata[bid].disk_id, end=' ')
     print('')
 
   def write_block(self, id, block_no, block_info):
+    if self.metrics is None and self.tracer is None:
+      return self._write_disk_block(id, block_no, block_info)
+    start = time.perf_counter()
+    res = self._write_disk_block(id, block_no, block_info)
+    duration = time.perf_counter() - start
+    if self.metrics is not None:
+      self.metrics.record_op('write', id, len(block_info) if res else 0, res,
+                             duration)
+    if self.tracer is not None:
+      self.tracer.emit('write', id, block_no, self._physical_block(id, block_no),
+                       len(block_info), res, duration)
+    return res
+
+  def _write_disk_block(self, id, block_no, block_info):
     if not id in self.disk_metadata:
-      print('Invalid disk id')
+      self._log('Invalid disk id')
       return False
     metadata = self.disk_metadata[id]
-    pid = metadata.disk_blocks()[block_no-1]
+    if block_no > len(metadata.disk_blocks()) or block_no < 1:
+      self._log('Invalid block no')
+      return False
+    pid = self._own_block(id, block_no)
+    if pid < 0:
+      return False
     return self._write_block(pid+1, block_info)
 
-  def read_block(self, id, block_no, block_info):  
+  def read_block(self, id, block_no, block_info):
+    if self.metrics is None and self.tracer is None:
+      return self._read_disk_block(id, block_no, block_info)
+    start = time.perf_counter()
+    res = self._read_disk_block(id, block_no, block_info)
+    duration = time.perf_counter() - start
+    ok = res is not False and res >= 0
+    if self.metrics is not None:
+      self.metrics.record_op('read', id, res if ok else 0, ok, duration)
+    if self.tracer is not None:
+      self.tracer.emit('read', id, block_no, self._physical_block(id, block_no),
+                       len(block_info), res, duration)
+    return res
+
+  def _read_disk_block(self, id, block_no, block_info):
     if not id in self.disk_metadata:
-      print('Invalid disk id')
+      self._log('Invalid disk id')
       return -1
     metadata = self.disk_metadata[id]
+    if block_no > len(metadata.disk_blocks()) or block_no < 1:
+      self._log('Invalid block no')
+      return -1
     pid = metadata.disk_blocks()[block_no-1]
     return self._read_block(pid+1, block_info)
 
   def create_checkpoint(self, disk_id):
+    if self.metrics is None and self.tracer is None:
+      return self._create_checkpoint(disk_id)
+    start = time.perf_counter()
+    res = self._create_checkpoint(disk_id)
+    duration = time.perf_counter() - start
+    if self.metrics is not None:
+      self.metrics.record_op('checkpoint', disk_id, 0, res >= 0, duration)
+    if self.tracer is not None:
+      self.tracer.emit('checkpoint', disk_id, -1, -1, 0, res, duration)
+    return res
+
+  def _create_checkpoint(self, disk_id):
     if not disk_id in self.disk_metadata:
-      print('Invalid disk id')
+      self._log('Invalid disk id')
       return -1
     disk_data = self.disk_metadata[disk_id]
-    snapshot = []
-    for bid in disk_data.disk_blocks():
-      block_info = bytearray(100)
-      self._read_block(bid+1, block_info)
-      snapshot.append((copy.deepcopy(self.block_metadata[bid]),
-                       block_info))
+    # A snapshot is a frozen copy of the block map, the blocks themselves
+    # are shared until the disk writes to them.
+    snapshot = tuple(disk_data.disk_blocks())
+    for bid in snapshot:
+      self.block_metadata[bid].refs += 1
     disk_data.snapshots.append(snapshot)
     return len(disk_data.snapshots)-1
+
   def rollback(self, disk_id, snapshot_id):
     if not disk_id in self.disk_metadata:
-      print('Invalid disk id')
+      self._log('Invalid disk id')
       return False
     disk_data = self.disk_metadata[disk_id]
     if snapshot_id >= len(disk_data.snapshots) or snapshot_id < 0:
-      print('Invalid snapshot id')
+      self._log('Invalid snapshot id')
       return False
+    # Repoint the disk at the snapshot's block map. Snapshot blocks are
+    # never written in place, so the snapshot stays usable afterwards.
     snapshot = disk_data.snapshots[snapshot_id]
-    disk_blocks = disk_data.disk_blocks()
-    for i in range(len(disk_blocks)):
-      bid = disk_blocks[i]
-      (block_data,block_info) = snapshot[i]
-      self._write_block(bid + 1, block_info)
-      self.block_metadata[bid] = block_data
+    for bid in snapshot:
+      self.block_metadata[bid].refs += 1
+    for bid in disk_data.disk_blocks():
+      self._release_block(bid)
+    disk_data.blocks = list(snapshot)
+    return True
+
+  def clone_disk(self, src_id, snapshot_id, new_id):
+    if not src_id in self.disk_metadata:
+      self._log('Invalid disk id')
+      return False
+    if new_id in self.disk_metadata:
+      self._log('A disk with given id exists')
+      return False
+    src_data = self.disk_metadata[src_id]
+    if snapshot_id >= len(src_data.snapshots) or snapshot_id < 0:
+      self._log('Invalid snapshot id')
+      return False
+    # The clone starts out sharing every block of the snapshot, so only
+    # the block map is copied.
+    snapshot = src_data.snapshots[snapshot_id]
+    metadata = DiskInfo()
+    metadata.blocks = list(snapshot)
+    for bid in snapshot:
+      self.block_metadata[bid].refs += 1
+    self.disk_metadata[new_id] = metadata
+    return True
 
 def test_snapshot():
   vfs = VFS()
@@ -203,5 +416,56 @@ def test_snapshot():
   vfs.rollback('A',s1)
   print_disk()
 
+def test_clone():
+  vfs = VFS()
+  print('Creating Disk A of size 3 Blocks')
+  vfs.create_disk('A', 3)
+  vfs.write_block('A', 1, bytearray(b'golden'))
+  vfs.write_block('A', 2, bytearray(b'image'))
+  s0 = vfs.create_checkpoint('A')
+  print('Created Checkpoint ', s0)
+  print('Cloning Disk B and Disk C from Checkpoint ', s0)
+  vfs.clone_disk('A', s0, 'B')
+  vfs.clone_disk('A', s0, 'C')
+  vfs.print_block_allocation()
+  print('Editing Disk B')
+  vfs.write_block('B', 1, bytearray(b'clone'))
+  vfs.write_block('B', 3, bytearray(b'new'))
+  vfs.print_block_allocation()
+  block_info = bytearray(20)
+  for id in 'ABC':
+    print('Disk', id, end=': ')
+    for i in range(1, 4):
+      sz = vfs.read_block(id, i, block_info)
+      print(block_info[:sz].decode('utf-8'), end=' | ')
+    print()
+  print('Deleting Disk A, clones keep the shared blocks')
+  vfs.delete_disk('A')
+  vfs.print_block_allocation()
+  sz = vfs.read_block('C', 1, block_info)
+  print('Disk C block 1:', block_info[:sz].decode('utf-8'))
+
+def test_lazy():
+  start = time.perf_counter()
+  vfs = VFS(disk_1_blocks=4000000, disk_2_blocks=6000000, lazy=True)
+  print('Created a lazy VFS of 10M blocks in %.3fs' % (time.perf_counter() - start))
+  vfs.create_disk('A', 1000)
+  vfs.write_block('A', 1, bytearray(b'lazy'))
+  s0 = vfs.create_checkpoint('A')
+  vfs.clone_disk('A', s0, 'B')
+  vfs.write_block('B', 1, bytearray(b'clone'))
+  block_info = bytearray(10)
+  for id in 'AB':
+    sz = vfs.read_block(id, 1, block_info)
+    print('Disk', id, 'block 1:', block_info[:sz].decode('utf-8'))
+  print('Materialized metadata:', len(vfs.block_metadata.items),
+        'buffers:', len(vfs.disk_1.items) + len(vfs.disk_2.items))
+  print('Allocation stats:', vfs.allocation_stats())
+  vfs.delete_disk('B')
+  vfs.delete_disk('A')
+  print('After deleting, materialized metadata:', len(vfs.block_metadata.items))
+
 if __name__ == '__main__':
-  test_snapshot()
\ No newline at end of file
+  test_snapshot()
+  test_clone()
+  test_lazy()
\ No newline at end of file
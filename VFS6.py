@@ -0,0 +1,396 @@
+"""
+Supports sharding of virtual disks across a pool of worker processes.
+Each disk lives on the shard picked by hashing its id. A shard keeps its
+blocks in a shared memory segment and does all block copies itself.
+Every client (the VFS, and any extra ones from VFS.client()) has its own
+pipe to each shard and its own payload slots in shared memory: write data
+is put into a slot instead of being pickled over the pipe, and the shard
+copies read data into the slot of the request. Clients in separate
+processes are served by the shards concurrently.
+"""
+from multiprocessing import connection, shared_memory
+from collections import deque
+import multiprocessing as mp
+import zlib
+
+BLOCK_SIZE = 100
+
+class BlockInfo:
+  def __init__(self):
+    self.size = 0
+    self.free = True
+    self.unallocated = True
+    self.disk_id = None
+
+  def reset(self):
+    self.__init__()
+
+class DiskInfo:
+  def __init__(self):
+    self.blocks = []
+  def disk_blocks(self):
+    return self.blocks
+
+class Shard:
+  # Lives inside a worker process. Block data is stored in the shared
+  # memory segment, block/disk metadata stays private to the worker.
+  # 'slots' are the payload slots of each client on this shard.
+  def __init__(self, shm_name, num_blocks, slots):
+    self.shm = shared_memory.SharedMemory(name=shm_name)
+    self.buf = self.shm.buf
+    self.slots = slots
+    self.num_blocks = num_blocks
+    self.block_metadata = [BlockInfo() for i in range(num_blocks)]
+    self.disk_metadata = {}
+    self.free_blocks = deque([i for i in range(num_blocks)])
+
+  def close(self):
+    self.buf.release()
+    self.shm.close()
+
+  def handle(self, client, request):
+    # ('io', [(is_write, id, block_no, size), ...]) uses slot i of 'client'
+    # for the i-th entry, ('call', op, args) runs a disk API method.
+    if request[0] == 'call':
+      return getattr(self, request[1])(*request[2])
+    slots = self.slots[client]
+    return [self.write_block(id, block_no, slots, i*BLOCK_SIZE, size)
+            if is_write else
+            self.read_block(id, block_no, slots, i*BLOCK_SIZE, size)
+            for i, (is_write, id, block_no, size) in enumerate(request[1])]
+
+  def create_disk(self, id, size):
+    if id in self.disk_metadata:
+      print('A disk with given id exists')
+      return False
+    if size > len(self.free_blocks):
+      print('Out of memory!')
+      return False
+    metadata = DiskInfo()
+    while size > 0:
+      bid = self.free_blocks.popleft()
+      block_data = self.block_metadata[bid]
+      block_data.unallocated = False
+      block_data.disk_id = id
+      metadata.blocks.append(bid)
+      size -= 1
+    self.disk_metadata[id] = metadata
+    return True
+
+  def delete_disk(self, id):
+    if not id in self.disk_metadata:
+      print('No disk with given id found!')
+      return False
+    metadata = self.disk_metadata[id]
+    for bid in metadata.disk_blocks():
+      self.free_blocks.append(bid)
+      self.block_metadata[bid].reset()
+    self.disk_metadata.pop(id)
+    return True
+
+  def block_allocation(self):
+    return [None if x.unallocated else x.disk_id for x in self.block_metadata]
+
+  def _physical_block(self, id, block_no):
+    if not id in self.disk_metadata:
+      print('Invalid disk id')
+      return -1
+    metadata = self.disk_metadata[id]
+    if block_no > len(metadata.disk_blocks()) or block_no < 1:
+      print('Invalid block no')
+      return -1
+    return metadata.disk_blocks()[block_no-1]
+
+  def write_block(self, id, block_no, slots, src, size):
+    # Copies 'size' bytes at offset 'src' of 'slots' into the block.
+    pid = self._physical_block(id, block_no)
+    if pid < 0:
+      return False
+    metadata = self.block_metadata[pid]
+    metadata.size = size
+    metadata.free = False
+    offset = pid*BLOCK_SIZE
+    self.buf[offset:offset+size] = slots[src:src+size]
+    return True
+
+  def read_block(self, id, block_no, slots, dst, size):
+    # Copies up to 'size' bytes of the block to offset 'dst' of 'slots'.
+    pid = self._physical_block(id, block_no)
+    if pid < 0:
+      return -1
+    metadata = self.block_metadata[pid]
+    if metadata.free:
+      return 0
+    res_size = min(size, metadata.size)
+    offset = pid*BLOCK_SIZE
+    slots[dst:dst+res_size] = self.buf[offset:offset+res_size]
+    return res_size
+
+def shard_worker(shard_no, conns, shm_name, num_blocks, slot_names, num_slots):
+  # conns[c] is the pipe of client c. A None request from any client stops
+  # the shard.
+  segments = [shared_memory.SharedMemory(name=name) for name in slot_names]
+  region = shard_no*num_slots*BLOCK_SIZE
+  slots = [segment.buf[region:region+num_slots*BLOCK_SIZE]
+           for segment in segments]
+  shard = Shard(shm_name, num_blocks, slots)
+  clients = {conn: c for c, conn in enumerate(conns)}
+  running = True
+  while running and clients:
+    for conn in connection.wait(list(clients)):
+      try:
+        request = conn.recv()
+      except EOFError:
+        clients.pop(conn)
+        continue
+      if request is None:
+        running = False
+        break
+      conn.send(shard.handle(clients[conn], request))
+  shard.close()
+  for view in slots:
+    view.release()
+  for segment in segments:
+    segment.close()
+  for conn in conns:
+    conn.close()
+
+def shard_of(id, num_shards):
+  # crc32 instead of hash() so the placement does not depend on
+  # PYTHONHASHSEED and stays the same across runs.
+  return zlib.crc32(str(id).encode()) % num_shards
+
+class Client:
+  """
+  Disk API of the sharded VFS for one caller. A client can be handed to
+  another process (e.g. as a multiprocessing.Process argument) and used
+  there, but a single client must not be used by two processes at once.
+  """
+  def __init__(self, conns, segment, num_slots):
+    self.conns = conns
+    self.segment = segment
+    self.num_slots = num_slots
+    self.buf = None
+
+  def _slots(self):
+    # Mapped on first use, in the process the client ends up in.
+    if self.buf is None:
+      self.buf = self.segment.buf
+    return self.buf
+
+  def shard_of(self, id):
+    return shard_of(id, len(self.conns))
+
+  def _call(self, shard, op, *args):
+    self.conns[shard].send(('call', op, args))
+    return self.conns[shard].recv()
+
+  def create_disk(self, id, size):
+    return self._call(self.shard_of(id), 'create_disk', id, size)
+
+  def delete_disk(self, id):
+    return self._call(self.shard_of(id), 'delete_disk', id)
+
+  def write_block(self, id, block_no, block_info):
+    return self.submit([('write', id, block_no, block_info)])[0]
+
+  def read_block(self, id, block_no, block_info):
+    return self.submit([('read', id, block_no, block_info)])[0]
+
+  def submit(self, requests):
+    """
+    Runs a list of ('read' | 'write', id, block_no, block_info) requests,
+    sending one message per shard instead of one per request. Shards work
+    on their part of the batch in parallel, in request order. Returns the
+    results in the order of the requests.
+    """
+    buf = self._slots()
+    results = [None]*len(requests)
+    batches = [[] for conn in self.conns]
+    indices = [[] for conn in self.conns]
+    for i, (op, id, block_no, block_info) in enumerate(requests):
+      shard = self.shard_of(id)
+      offset = (shard*self.num_slots + len(batches[shard]))*BLOCK_SIZE
+      if op == 'write':
+        size = len(block_info)
+        if size > BLOCK_SIZE:
+          print('Block data too big')
+          results[i] = False
+          continue
+        buf[offset:offset+size] = block_info
+        batches[shard].append((True, id, block_no, size))
+      else:
+        batches[shard].append((False, id, block_no,
+                               min(len(block_info), BLOCK_SIZE)))
+      indices[shard].append(i)
+      if len(batches[shard]) == self.num_slots:
+        # Out of slots on this shard.
+        self._run_batches(requests, results, batches, indices)
+    self._run_batches(requests, results, batches, indices)
+    return results
+
+  def _run_batches(self, requests, results, batches, indices):
+    buf = self._slots()
+    for shard, batch in enumerate(batches):
+      if batch:
+        self.conns[shard].send(('io', batch))
+    for shard, batch in enumerate(batches):
+      if not batch:
+        continue
+      offset = shard*self.num_slots*BLOCK_SIZE
+      for i, res in zip(indices[shard], self.conns[shard].recv()):
+        results[i] = res
+        if requests[i][0] != 'write' and res > 0:
+          requests[i][3][:res] = buf[offset:offset+res]
+        offset += BLOCK_SIZE
+      batch.clear()
+      indices[shard].clear()
+
+  def block_allocation(self, shard):
+    return self._call(shard, 'block_allocation')
+
+  def close(self):
+    # Unmaps the slots in this process, the VFS owns the segment.
+    if self.buf is not None:
+      self.buf.release()
+      self.buf = None
+    self.segment.close()
+
+class VFS(Client):
+  def __init__(self, num_shards=None, blocks_per_shard=500, num_clients=1,
+               num_slots=256):
+    # num_clients: clients served concurrently, client(0) is this VFS.
+    # num_slots: requests per shard in one message of a client.
+    if num_shards is None:
+      num_shards = mp.cpu_count()
+    self.blocks_per_shard = blocks_per_shard
+    self.segments = []
+    self.slot_segments = [
+      shared_memory.SharedMemory(create=True,
+                                 size=num_shards*num_slots*BLOCK_SIZE)
+      for c in range(num_clients)]
+    # client_conns[c][shard] is the pipe of client c to the shard.
+    client_conns = [[] for c in range(num_clients)]
+    self.workers = []
+    for i in range(num_shards):
+      shm = shared_memory.SharedMemory(create=True,
+                                       size=blocks_per_shard*BLOCK_SIZE)
+      pipes = [mp.Pipe() for c in range(num_clients)]
+      slot_names = [segment.name for segment in self.slot_segments]
+      worker = mp.Process(target=shard_worker,
+                          args=(i, [child for (conn, child) in pipes],
+                                shm.name, blocks_per_shard, slot_names,
+                                num_slots),
+                          daemon=True)
+      worker.start()
+      for c, (conn, child) in enumerate(pipes):
+        child.close()
+        client_conns[c].append(conn)
+      self.segments.append(shm)
+      self.workers.append(worker)
+    self.clients = [Client(conns, segment, num_slots)
+                    for conns, segment in zip(client_conns, self.slot_segments)]
+    Client.__init__(self, client_conns[0], self.slot_segments[0], num_slots)
+
+  def client(self, i):
+    return self.clients[i]
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def close(self):
+    # Clients in other processes must be done before the VFS is closed.
+    if not self.workers:
+      return
+    for conn in self.conns:
+      conn.send(None)
+    for worker in self.workers:
+      worker.join()
+    for client in self.clients:
+      for conn in client.conns:
+        conn.close()
+    if self.buf is not None:
+      self.buf.release()
+      self.buf = None
+    for shm in self.segments + self.slot_segments:
+      shm.close()
+      shm.unlink()
+    self.segments = []
+    self.slot_segments = []
+    self.clients = []
+    self.workers = []
+
+  def print_block_allocation(self):
+    for shard in range(len(self.conns)):
+      print('Shard', shard, end=': ')
+      for disk_id in self.block_allocation(shard):
+        if disk_id is None:
+          print('__', end=' ')
+        else:
+          print(disk_id, end=' ')
+      print('')
+
+def _client_worker(client, ids, start):
+  start.wait()
+  requests = [('write', id, 1, bytearray(('from ' + id).encode()))
+              for id in ids]
+  requests += [('read', id, 1, bytearray(10)) for id in ids]
+  for (op, id, block_no, buff), res in zip(requests, client.submit(requests)):
+    if op == 'read':
+      print('Client read', id, buff[:res].decode('utf-8'))
+  client.close()
+
+def test_sharding():
+  with VFS(num_shards=4, blocks_per_shard=20) as vfs:
+    for id in 'ABCDEF':
+      print('Creating Disk', id, 'of size 5 blocks on shard', vfs.shard_of(id))
+      vfs.create_disk(id, 5)
+    vfs.print_block_allocation()
+    print('Writing buff=shubham at block 1 in Disk A')
+    vfs.write_block('A', 1, bytearray(b'shubham'))
+    rbuff = bytearray(10)
+    vfs.read_block('A', 1, rbuff)
+    print('rbuff = ', rbuff.decode('utf-8'))
+
+    print('Writing and reading block 2 of every disk in one batch')
+    requests = [('write', id, 2, bytearray(('disk ' + id).encode()))
+                for id in 'ABCDEF']
+    requests += [('read', id, 2, bytearray(10)) for id in 'ABCDEF']
+    results = vfs.submit(requests)
+    for (op, id, block_no, buff), res in zip(requests, results):
+      if op == 'read':
+        print(id, res, buff[:res].decode('utf-8'))
+
+    print('Reading unwritten block 3 in Disk B')
+    print(vfs.read_block('B', 3, rbuff))
+    print('Reading block 10 in Disk B')
+    print(vfs.read_block('B', 10, rbuff))
+    print('Deleting Disk A')
+    vfs.delete_disk('A')
+    vfs.read_block('A', 1, rbuff)
+    vfs.print_block_allocation()
+
+def test_clients():
+  with VFS(num_shards=2, blocks_per_shard=20, num_clients=3) as vfs:
+    for id in 'ABCDEF':
+      vfs.create_disk(id, 5)
+    print('Two client processes using Disks A-C and D-F concurrently')
+    start = mp.Event()
+    workers = [mp.Process(target=_client_worker,
+                          args=(vfs.client(c), ids, start))
+               for c, ids in ((1, 'ABC'), (2, 'DEF'))]
+    for worker in workers:
+      worker.start()
+    start.set()
+    for worker in workers:
+      worker.join()
+    rbuff = bytearray(10)
+    sz = vfs.read_block('E', 1, rbuff)
+    print('Block 1 of Disk E:', rbuff[:sz].decode('utf-8'))
+
+if __name__ == '__main__':
+  test_sharding()
+  test_clients()
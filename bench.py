@@ -0,0 +1,405 @@
+"""
+Benchmarks for the VFS variants.
+Times the block read/write path of every variant, concurrent clients of
+the sharded VFS6, disk creation/deletion
+under fragmentation churn (VFS2 vs VFS3), per-call vs transactional
+disk churn in disks per second (VFS3), replica failover at several
+read error rates and batched replicated writes (VFS4), and
+checkpoint/rollback against disk size and eager vs lazy construction
+(VFS5).
+Results are written as JSON and can be compared against a stored baseline:
+
+  python bench.py --output bench.json
+  python bench.py --save-baseline baseline.json
+  python bench.py --baseline baseline.json --tolerance 0.2
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import time
+
+import VFS1
+import VFS2
+import VFS3
+import VFS4
+import VFS5
+import VFS6
+
+def timed(setup, run, repeat):
+  # Best of 'repeat' runs, each on fresh state from setup(). Prints of the
+  # VFS modules are swallowed so the terminal is not part of the timing.
+  best = None
+  for i in range(repeat):
+    with contextlib.redirect_stdout(io.StringIO()):
+      state = setup()
+      start = time.perf_counter()
+      run(state)
+      elapsed = time.perf_counter() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+def result(name, params, ops, seconds, **extra):
+  res = {'name': name, 'params': params, 'ops': ops, 'seconds': seconds,
+         'ops_per_sec': ops/seconds if seconds > 0 else 0.0}
+  res.update(extra)
+  return res
+
+def key(res):
+  params = ','.join('%s=%s' % (k, res['params'][k]) for k in sorted(res['params']))
+  return '%s[%s]' % (res['name'], params)
+
+def bench_block_io(seed, repeat):
+  disk_size = 100
+  for payload in (10, 50, 100):
+    data = bytearray(b'x'*payload)
+
+    def run_raw(vfs):
+      buff = bytearray(100)
+      for bid in range(1, disk_size+1):
+        vfs.write_block(bid, data)
+      for bid in range(1, disk_size+1):
+        vfs.read_block(bid, buff)
+    seconds = timed(VFS1.VFS, run_raw, repeat)
+    yield result('block_io', {'vfs': 'VFS1', 'payload': payload},
+                 2*disk_size, seconds)
+
+    def run(vfs):
+      buff = bytearray(100)
+      for i in range(1, disk_size+1):
+        vfs.write_block('A', i, data)
+      for i in range(1, disk_size+1):
+        vfs.read_block('A', i, buff)
+    for module in (VFS2, VFS3, VFS4, VFS5):
+      def setup():
+        random.seed(seed)
+        vfs = module.VFS()
+        vfs.create_disk('A', disk_size)
+        return vfs
+      generate_read_errors = VFS4.generate_read_errors
+      VFS4.generate_read_errors = False
+      try:
+        seconds = timed(setup, run, repeat)
+      finally:
+        VFS4.generate_read_errors = generate_read_errors
+      yield result('block_io', {'vfs': module.__name__, 'payload': payload},
+                   2*disk_size, seconds)
+
+@contextlib.contextmanager
+def quiet_fd():
+  # Points file descriptor 1 at /dev/null, for child processes whose prints
+  # redirect_stdout() does not reach.
+  sys.stdout.flush()
+  saved = os.dup(1)
+  devnull = os.open(os.devnull, os.O_WRONLY)
+  os.dup2(devnull, 1)
+  os.close(devnull)
+  try:
+    yield
+  finally:
+    sys.stdout.flush()
+    os.dup2(saved, 1)
+    os.close(saved)
+
+def _sharded_client(client, requests, batches, start, done):
+  start.wait()
+  failed = 0
+  for i in range(batches):
+    for (op, id, block_no, block_info), res in zip(requests,
+                                                   client.submit(requests)):
+      if res is not True and res != len(block_info):
+        failed += 1
+  done.put((time.perf_counter(), failed))
+  client.close()
+
+def bench_sharded_io(seed, repeat):
+  # One client process per shard, each submitting batches of 100-byte
+  # writes and reads of its own disks. Process startup is not timed, the
+  # clock runs from releasing the clients until the last one finishes.
+  # Throughput can only scale up to the number of cores.
+  batches = 20
+  disks_per_client = 8
+  for shards in (1, 2, 4):
+    clients = shards
+    best = None
+    disks = range(clients*disks_per_client)
+    # crc32 placement is uneven, size the shards for the fullest one.
+    placed = [VFS6.shard_of(d, shards) for d in disks]
+    blocks_per_shard = max(placed.count(s) for s in range(shards))*50
+    with quiet_fd():
+      vfs = VFS6.VFS(num_shards=shards, blocks_per_shard=blocks_per_shard,
+                     num_clients=clients+1)
+    try:
+      for d in disks:
+        if not vfs.create_disk(d, 50):
+          raise RuntimeError('sharded_io: could not create disk %d' % d)
+      data = bytearray(b'x'*100)
+      for r in range(repeat):
+        start = multiprocessing.Event()
+        done = multiprocessing.Queue()
+        workers = []
+        for c in range(clients):
+          mine = disks[c*disks_per_client:(c+1)*disks_per_client]
+          requests = [('write', d, i, data) for d in mine
+                      for i in range(1, 51)]
+          requests += [('read', d, i, bytearray(100)) for d in mine
+                       for i in range(1, 51)]
+          workers.append(multiprocessing.Process(
+            target=_sharded_client,
+            args=(vfs.client(c+1), requests, batches, start, done)))
+        with quiet_fd():
+          for worker in workers:
+            worker.start()
+        time.sleep(0.1)
+        begin = time.perf_counter()
+        start.set()
+        reports = [done.get() for worker in workers]
+        for worker in workers:
+          worker.join()
+        failed = sum(failed for (end, failed) in reports)
+        if failed:
+          raise RuntimeError('sharded_io: %d requests failed' % failed)
+        end = max(end for (end, failed) in reports)
+        if best is None or end - begin < best:
+          best = end - begin
+    finally:
+      vfs.close()
+    yield result('sharded_io', {'shards': shards, 'clients': clients},
+                 clients*batches*len(requests), best)
+
+def bench_disk_churn(seed, repeat):
+  ops = 400
+  variants = [('VFS2', lambda: VFS2.VFS()),
+              ('VFS3', lambda: VFS3.VFS()),
+              ('VFS3-locality', lambda: VFS3.VFS(locality=True))]
+  for max_size in (5, 20, 50):
+    for (name, factory) in variants:
+      created = []
+
+      def run(vfs):
+        rng = random.Random(seed)
+        live = []
+        done = 0
+        for i in range(ops):
+          if live and rng.random() < 0.5:
+            vfs.delete_disk(live.pop(rng.randrange(len(live))))
+          elif vfs.create_disk(i, rng.randint(1, max_size)):
+            live.append(i)
+            done += 1
+        created.append(done)
+      seconds = timed(factory, run, repeat)
+      yield result('disk_churn', {'vfs': name, 'max_size': max_size}, ops,
+                   seconds, disks_created=created[-1])
+
+def bench_disk_txn(seed, repeat):
+  # The same churn of creates and deletes, one call per disk vs one
+  # transaction per round. Ops are disks created or deleted.
+  rounds = 20
+  for batch in (4, 16, 64):
+    rng = random.Random(seed)
+    plan = []
+    live = []
+    next_id = 0
+    for r in range(rounds):
+      ops = []
+      for i in range(batch):
+        if live and rng.random() < 0.5:
+          ops.append(('delete', live.pop(rng.randrange(len(live)))))
+        elif len(live) < 500//(2*batch):
+          ops.append(('create', next_id, rng.randint(1, batch)))
+          live.append(next_id)
+          next_id += 1
+      plan.append(ops)
+    disks = sum(len(ops) for ops in plan)
+
+    def run_calls(vfs):
+      for ops in plan:
+        for op in ops:
+          if op[0] == 'create':
+            vfs.create_disk(op[1], op[2])
+          else:
+            vfs.delete_disk(op[1])
+
+    def run_txn(vfs):
+      for ops in plan:
+        vfs.transaction(ops)
+    for (mode, run) in (('calls', run_calls), ('transaction', run_txn)):
+      seconds = timed(VFS3.VFS, run, repeat)
+      yield result('disk_txn', {'mode': mode, 'batch': batch}, disks, seconds)
+
+def bench_failover(seed, repeat):
+  disk_size = 100
+  data = bytearray(b'x'*50)
+  for prob in (0.0, 0.05, 0.1, 0.3):
+    stats = []
+
+    def setup():
+      VFS4.read_error_prob = 0.0
+      vfs = VFS4.VFS()
+      vfs.create_disk('A', disk_size)
+      for i in range(1, disk_size+1):
+        vfs.write_block('A', i, data)
+      random.seed(seed)
+      VFS4.read_error_prob = prob
+      return vfs
+
+    def run(vfs):
+      buff = bytearray(100)
+      for i in range(1, disk_size+1):
+        vfs.read_block('A', i, buff)
+      stats.append((vfs.original_read_error, vfs.replica_read_error))
+
+    read_error_prob = VFS4.read_error_prob
+    try:
+      seconds = timed(setup, run, repeat)
+    finally:
+      VFS4.read_error_prob = read_error_prob
+    yield result('failover', {'read_error_prob': prob}, disk_size, seconds,
+                 original_read_error=stats[-1][0],
+                 replica_read_error=stats[-1][1])
+
+def bench_replicated_write(seed, repeat):
+  # Acknowledgement latency of replicated writes, one call per block vs
+  # batched write_blocks() with each ack policy.
+  disk_size = 100
+  data = bytearray(b'x'*100)
+  blocks = [(i, data) for i in range(1, disk_size+1)]
+  vfss = []
+
+  def setup():
+    vfs = VFS4.VFS()
+    vfs.create_disk('A', disk_size)
+    vfss.append(vfs)
+    return vfs
+
+  def run_serial(vfs):
+    for (i, block_info) in blocks:
+      vfs.write_block('A', i, block_info)
+  try:
+    seconds = timed(setup, run_serial, repeat)
+    yield result('replicated_write', {'mode': 'serial'}, disk_size, seconds)
+    for ack in ('all', 'primary'):
+      seconds = timed(setup, lambda vfs: vfs.write_blocks('A', blocks, ack),
+                      repeat)
+      yield result('replicated_write', {'mode': 'batch-' + ack}, disk_size,
+                   seconds)
+  finally:
+    for vfs in vfss:
+      vfs.close()
+
+def bench_checkpoint(seed, repeat):
+  for disk_size in (10, 100, 250):
+    data = bytearray(b'x'*100)
+
+    def setup():
+      vfs = VFS5.VFS()
+      vfs.create_disk('A', disk_size)
+      for i in range(1, disk_size+1):
+        vfs.write_block('A', i, data)
+      return vfs
+
+    def run_checkpoint(vfs):
+      vfs.create_checkpoint('A')
+    seconds = timed(setup, run_checkpoint, repeat)
+    yield result('checkpoint', {'disk_size': disk_size}, 1, seconds)
+
+    def setup_rollback():
+      vfs = setup()
+      vfs.create_checkpoint('A')
+      for i in range(1, disk_size+1):
+        vfs.write_block('A', i, data)
+      return vfs
+
+    def run_rollback(vfs):
+      vfs.rollback('A', 0)
+    seconds = timed(setup_rollback, run_rollback, repeat)
+    yield result('rollback', {'disk_size': disk_size}, 1, seconds)
+
+def bench_startup(seed, repeat):
+  # Eager construction is skipped for the largest volume, it needs GBs.
+  for blocks in (500, 100000, 10000000):
+    for lazy in (False, True):
+      if blocks > 100000 and not lazy:
+        continue
+
+      def run(state):
+        VFS5.VFS(disk_1_blocks=blocks*2//5, disk_2_blocks=blocks-blocks*2//5,
+                 lazy=lazy)
+      seconds = timed(lambda: None, run, repeat)
+      yield result('startup', {'blocks': blocks, 'lazy': lazy}, 1, seconds)
+
+BENCHMARKS = {
+  'block_io': bench_block_io,
+  'sharded_io': bench_sharded_io,
+  'disk_churn': bench_disk_churn,
+  'disk_txn': bench_disk_txn,
+  'failover': bench_failover,
+  'replicated_write': bench_replicated_write,
+  'checkpoint': bench_checkpoint,
+  'startup': bench_startup,
+}
+
+def compare(results, baseline, tolerance):
+  # Returns the results that got slower per op than the baseline by more
+  # than 'tolerance'.
+  base = {key(res): res for res in baseline['results']}
+  regressions = []
+  for res in results:
+    old = base.get(key(res))
+    if old is None or old['ops'] == 0 or res['ops'] == 0:
+      continue
+    ratio = (res['seconds']/res['ops']) / (old['seconds']/old['ops'])
+    res['baseline_ratio'] = ratio
+    if ratio > 1 + tolerance:
+      regressions.append(res)
+  return regressions
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark the VFS variants.')
+  parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS),
+                      help='benchmarks to run, all by default')
+  parser.add_argument('--repeat', type=int, default=5,
+                      help='runs per case, the best one is reported')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', help='write the JSON results to this file')
+  parser.add_argument('--baseline', help='JSON results to compare against')
+  parser.add_argument('--tolerance', type=float, default=0.2,
+                      help='allowed slowdown per op against the baseline')
+  parser.add_argument('--save-baseline',
+                      help='write the results as a new baseline file')
+  args = parser.parse_args(argv)
+
+  results = []
+  for name in args.only or list(BENCHMARKS):
+    for res in BENCHMARKS[name](args.seed, args.repeat):
+      print('%-45s %12.1f ops/s' % (key(res), res['ops_per_sec']),
+            file=sys.stderr)
+      results.append(res)
+
+  regressions = []
+  if args.baseline:
+    with open(args.baseline) as f:
+      regressions = compare(results, json.load(f), args.tolerance)
+    for res in regressions:
+      print('REGRESSION %s: %.2fx slower than baseline'
+            % (key(res), res['baseline_ratio']), file=sys.stderr)
+
+  report = {'seed': args.seed, 'repeat': args.repeat,
+            'python': platform.python_version(), 'results': results}
+  for path in (args.output, args.save_baseline):
+    if path:
+      with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+  if not args.output and not args.save_baseline:
+    json.dump(report, sys.stdout, indent=2)
+    print()
+  return 1 if regressions else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
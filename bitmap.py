@@ -0,0 +1,151 @@
+"""
+Allocation bitmap used to track free blocks in VFS3-5.
+The map keeps one byte per block instead of one bit, so searching for free
+blocks and free runs is done by bytearray.find and re at C speed instead
+of bit twiddling in Python.
+A lazy bitmap starts out empty and treats every block past the end of the
+map as free, so a huge all-free volume costs O(1) to set up.
+"""
+import re
+
+FREE = 0
+USED = 1
+
+_runs = re.compile(b'\x00+|\x01+')
+_free_runs = re.compile(b'\x00+')
+
+class Bitmap:
+  def __init__(self, size, lazy=False):
+    self.size = size
+    self.map = bytearray() if lazy else bytearray(size)
+    self.free = size
+    # Cached largest_free_run(), None after any change to the map.
+    self.largest = None
+
+  def __len__(self):
+    return self.size
+
+  def _grow(self, end):
+    if end > len(self.map):
+      self.map.extend(bytes(end - len(self.map)))
+
+  def test(self, bid):
+    return bid < len(self.map) and self.map[bid] == USED
+
+  def set(self, bid):
+    self._grow(bid+1)
+    if self.map[bid] == FREE:
+      self.map[bid] = USED
+      self.free -= 1
+      self.largest = None
+
+  def clear(self, bid):
+    if bid < len(self.map) and self.map[bid] == USED:
+      self.map[bid] = FREE
+      self.free += 1
+      self.largest = None
+
+  def set_range(self, start, length):
+    if length <= 0:
+      return
+    self._grow(start+length)
+    self.free -= self.map.count(FREE, start, start+length)
+    self.map[start:start+length] = b'\x01'*length
+    self.largest = None
+
+  def clear_range(self, start, length):
+    if length <= 0:
+      return
+    self._grow(start+length)
+    self.free += self.map.count(USED, start, start+length)
+    self.map[start:start+length] = bytes(length)
+    self.largest = None
+
+  def find_first_zero(self, start=0):
+    bid = self.map.find(FREE, start)
+    if bid < 0:
+      bid = max(start, len(self.map))
+      if bid >= self.size:
+        return -1
+    return bid
+
+  def find_run(self, length, start=0):
+    # Start of the first run of at least 'length' free blocks, or -1.
+    bid = self.map.find(bytes(length), start)
+    if bid >= 0:
+      return bid
+    # The run may continue into the untracked tail of a lazy map.
+    bid = max(self.map.rfind(USED, start) + 1, start)
+    if self.size - bid >= length:
+      return bid
+    return -1
+
+  def allocate(self, count):
+    # Marks the 'count' lowest free blocks as used and returns their ids.
+    # A negative count allocates nothing.
+    if count <= 0:
+      return []
+    if count > self.free:
+      return None
+    bids = []
+    bid = -1
+    while len(bids) < count:
+      bid = self.map.find(FREE, bid+1)
+      if bid < 0:
+        break
+      self.map[bid] = USED
+      bids.append(bid)
+    # The rest comes from the untracked tail of a lazy map.
+    end = len(self.map)
+    rest = count - len(bids)
+    if rest:
+      bids.extend(range(end, end+rest))
+      self.map.extend(b'\x01'*rest)
+    self.free -= count
+    self.largest = None
+    return bids
+
+  def free_count(self):
+    return self.free
+
+  def free_runs(self):
+    # (start, length) of every run of free blocks.
+    spans = map(re.Match.span, _free_runs.finditer(self.map))
+    runs = [(start, end-start) for start, end in spans]
+    tail = self.size - len(self.map)
+    if tail:
+      if runs and sum(runs[-1]) == len(self.map):
+        runs[-1] = (runs[-1][0], runs[-1][1] + tail)
+      else:
+        runs.append((len(self.map), tail))
+    return runs
+
+  def largest_free_run(self):
+    if self.free == 0:
+      return 0
+    if self.largest is None:
+      # The free runs found by the regex, no object per used block.
+      largest = max(map(len, _free_runs.findall(self.map)), default=0)
+      # The run at the end continues into the untracked tail of a lazy map.
+      tail = self.size - self.map.rfind(USED) - 1
+      self.largest = max(largest, tail)
+    return self.largest
+
+  def fragmentation(self):
+    # 0 when all free space is a single run, approaching 1 as free space is
+    # split into many small runs.
+    if self.free == 0:
+      return 0.0
+    return 1 - self.largest_free_run()/self.free
+
+  def runs(self):
+    # Run-length encoded map: a list of (USED | FREE, length) pairs.
+    spans = map(re.Match.span, _runs.finditer(self.map))
+    runs = [(self.map[start], end-start) for start, end in spans]
+    tail = self.size - len(self.map)
+    if tail:
+      if runs and runs[-1][0] == FREE:
+        runs[-1] = (FREE, runs[-1][1] + tail)
+      else:
+        runs.append((FREE, tail))
+    return runs
@@ -0,0 +1,158 @@
+"""
+Counters and latency histograms for the VFS data path.
+A VFS records nothing until enable_metrics() hands it a Metrics object,
+until then the hot path only pays an 'is None' check.
+Updates are locked, VFS4 records from its writer threads.
+"""
+import threading
+
+class Histogram:
+  # HDR-style buckets over nanoseconds: values below 'sub_buckets' get a
+  # bucket each, every power of two above is split into 'sub_buckets'
+  # linear buckets. The relative error of a reported percentile is at most
+  # 1/sub_buckets at any magnitude.
+  def __init__(self, sub_buckets=16):
+    self.sub_buckets = sub_buckets
+    self.sub_bits = sub_buckets.bit_length() - 1
+    self.counts = {}
+    self.count = 0
+    self.sum = 0.0
+    self.max = 0.0
+
+  def _bucket(self, ns):
+    if ns < 2*self.sub_buckets:
+      return ns
+    shift = ns.bit_length() - self.sub_bits - 1
+    return shift*self.sub_buckets + (ns >> shift)
+
+  def _upper_bound(self, bucket):
+    # Largest value (in ns) that falls into 'bucket'.
+    if bucket < 2*self.sub_buckets:
+      return bucket
+    shift = bucket//self.sub_buckets - 1
+    return ((bucket - shift*self.sub_buckets + 1) << shift) - 1
+
+  def record(self, seconds):
+    bucket = self._bucket(int(seconds*1e9))
+    self.counts[bucket] = self.counts.get(bucket, 0) + 1
+    self.count += 1
+    self.sum += seconds
+    if seconds > self.max:
+      self.max = seconds
+
+  def percentile(self, q):
+    # Upper bound of the bucket holding the q-th percentile, in seconds.
+    if self.count == 0:
+      return 0.0
+    rank = q/100*self.count
+    seen = 0
+    for bucket in sorted(self.counts):
+      seen += self.counts[bucket]
+      if seen >= rank:
+        return min(self._upper_bound(bucket)/1e9, self.max)
+    return self.max
+
+  def cumulative(self, bounds):
+    # Number of values <= each bound (in seconds), for Prometheus buckets.
+    res = []
+    buckets = sorted(self.counts)
+    i = 0
+    seen = 0
+    for bound in bounds:
+      while i < len(buckets) and self._upper_bound(buckets[i]) <= bound*1e9:
+        seen += self.counts[buckets[i]]
+        i += 1
+      res.append(seen)
+    return res
+
+  def snapshot(self):
+    return {'count': self.count, 'sum': self.sum, 'max': self.max,
+            'p50': self.percentile(50), 'p90': self.percentile(90),
+            'p99': self.percentile(99), 'p999': self.percentile(99.9)}
+
+# Prometheus 'le' bounds: powers of two from ~1us to ~34s.
+PROMETHEUS_BOUNDS = [(1 << k)/1e9 for k in range(10, 36)]
+
+class Metrics:
+  def __init__(self):
+    # (name, ((label, value), ...)) -> count
+    self.counters = {}
+    # op -> Histogram
+    self.histograms = {}
+    self.lock = threading.Lock()
+
+  def inc(self, name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+  def observe(self, op, seconds):
+    with self.lock:
+      histogram = self.histograms.get(op)
+      if histogram is None:
+        histogram = self.histograms[op] = Histogram()
+      histogram.record(seconds)
+
+  def record_op(self, op, disk_id, nbytes, ok, seconds):
+    # One call of the virtual disk API.
+    self.inc('disk_ops_total', disk=disk_id, op=op)
+    if nbytes:
+      self.inc('disk_bytes_total', nbytes, disk=disk_id, op=op)
+    if not ok:
+      self.inc('disk_errors_total', disk=disk_id, op=op)
+    self.observe(op, seconds)
+
+  def record_device(self, block_no, op, nbytes, disk_1_blocks=200):
+    # One physical block access, block_no as passed to _read/_write_block.
+    device = 'disk_1' if block_no <= disk_1_blocks else 'disk_2'
+    self.inc('device_ops_total', device=device, op=op)
+    if nbytes:
+      self.inc('device_bytes_total', nbytes, device=device, op=op)
+
+  def snapshot(self):
+    counters = {}
+    with self.lock:
+      for (name, labels), value in self.counters.items():
+        counters.setdefault(name, []).append((dict(labels), value))
+      histograms = {op: h.snapshot() for op, h in self.histograms.items()}
+    return {'counters': counters, 'histograms': histograms}
+
+  def reset(self):
+    with self.lock:
+      self.counters = {}
+      self.histograms = {}
+
+  def export_prometheus(self, prefix='vfs'):
+    with self.lock:
+      lines = []
+      names = sorted(set(name for (name, labels) in self.counters))
+      for name in names:
+        lines.append('# TYPE %s_%s counter' % (prefix, name))
+        for (n, labels), value in sorted(self.counters.items(), key=str):
+          if n == name:
+            lines.append('%s_%s%s %d'
+                         % (prefix, name, _labels(labels), value))
+      if self.histograms:
+        name = prefix + '_op_latency_seconds'
+        lines.append('# TYPE %s histogram' % name)
+        for op in sorted(self.histograms):
+          histogram = self.histograms[op]
+          counts = histogram.cumulative(PROMETHEUS_BOUNDS)
+          for bound, count in zip(PROMETHEUS_BOUNDS, counts):
+            labels = _labels((('op', op), ('le', '%.9g' % bound)))
+            lines.append('%s_bucket%s %d' % (name, labels, count))
+          labels = _labels((('op', op), ('le', '+Inf')))
+          lines.append('%s_bucket%s %d' % (name, labels, histogram.count))
+          labels = _labels((('op', op),))
+          lines.append('%s_sum%s %.9g' % (name, labels, histogram.sum))
+          lines.append('%s_count%s %d' % (name, labels, histogram.count))
+      return '\n'.join(lines) + '\n'
+
+def _labels(labels):
+  if not labels:
+    return ''
+  escaped = []
+  for (label, value) in labels:
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    escaped.append('%s="%s"' % (label, value.replace('\n', '\\n')))
+  return '{' + ','.join(escaped) + '}'
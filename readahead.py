@@ -0,0 +1,193 @@
+"""
+Read-ahead for VFS3 virtual disks.
+Each stream (a disk, or a caller supplied handle) remembers the stride of
+its last reads. Once the same non-zero stride is seen twice in a row, the
+next 'window' blocks along it are prefetched into a shared buffer, for
+stride 1 with a single read_blocks() call. The window doubles each time a
+full window is consumed and halves when prefetched blocks go unused.
+All reads, writes and create/delete/resize calls of a disk have to go
+through the same ReadAhead, otherwise buffered blocks can be stale.
+"""
+from collections import OrderedDict
+
+class Stream:
+  def __init__(self, window):
+    self.last = None
+    self.stride = 0
+    self.sequential = False
+    self.window = window
+    # Next block to prefetch, everything before it along the stride is
+    # already buffered or consumed.
+    self.next = None
+    self.prefetched = set()
+    self.consumed = 0
+
+class ReadAhead:
+  def __init__(self, vfs, window=4, max_window=64, capacity=1024):
+    self.vfs = vfs
+    self.min_window = window
+    self.max_window = max_window
+    self.capacity = capacity
+    # (disk id, block no) -> (block data, stream key)
+    self.buffer = OrderedDict()
+    self.streams = {}
+    self.hits = 0
+    self.misses = 0
+
+  def read_block(self, id, block_no, block_info, stream=None):
+    entry = self.buffer.pop((id, block_no), None)
+    if entry is not None:
+      data, owner = entry
+      self._consumed(owner, (id, block_no))
+      self.hits += 1
+      res = min(len(block_info), len(data))
+      block_info[:res] = data[:res]
+    else:
+      self.misses += 1
+      res = self.vfs.read_block(id, block_no, block_info)
+      # Failed reads (unknown disk, bad block no) are not part of a stream.
+      if res is False or res < 0:
+        return res
+
+    key = id if stream is None else stream
+    state = self.streams.get(key)
+    if state is None:
+      state = self.streams[key] = Stream(self.min_window)
+    self._detect(state, block_no)
+    if state.sequential and id in self.vfs.disk_metadata:
+      self._prefetch(id, key, state, block_no)
+    return res
+
+  def write_block(self, id, block_no, block_info):
+    self._drop((id, block_no))
+    return self.vfs.write_block(id, block_no, block_info)
+
+  def create_disk(self, id, size):
+    self.invalidate(id)
+    return self.vfs.create_disk(id, size)
+
+  def delete_disk(self, id):
+    self.invalidate(id)
+    return self.vfs.delete_disk(id)
+
+  def resize_disk(self, id, size):
+    self.invalidate(id)
+    return self.vfs.resize_disk(id, size)
+
+  def transaction(self, ops):
+    for op in ops:
+      self.invalidate(op[1])
+    return self.vfs.transaction(ops)
+
+  def invalidate(self, id):
+    # Drops everything buffered for disk 'id' and its stream. The disk
+    # calls above do this, a disk changed behind the ReadAhead's back needs
+    # it done by hand.
+    for key in [key for key in self.buffer if key[0] == id]:
+      self._drop(key)
+    self.streams.pop(id, None)
+
+  def stats(self):
+    total = self.hits + self.misses
+    return {'hits': self.hits, 'misses': self.misses,
+            'hit_rate': self.hits/total if total else 0.0,
+            'buffered': len(self.buffer),
+            'windows': {key: state.window
+                        for key, state in self.streams.items()}}
+
+  def _detect(self, state, block_no):
+    stride = block_no - state.last if state.last is not None else 0
+    state.last = block_no
+    if stride != 0 and stride == state.stride:
+      state.sequential = True
+      return
+    if state.prefetched:
+      # The pattern broke with prefetched blocks still unread.
+      state.window = max(self.min_window, state.window//2)
+    state.stride = stride
+    state.sequential = False
+    state.next = None
+    state.consumed = 0
+
+  def _consumed(self, owner, key):
+    state = self.streams.get(owner)
+    if state is None or key not in state.prefetched:
+      return
+    state.prefetched.discard(key)
+    state.consumed += 1
+    if state.consumed >= state.window:
+      state.window = min(self.max_window, state.window*2)
+      state.consumed = 0
+
+  def _drop(self, key):
+    entry = self.buffer.pop(key, None)
+    if entry is not None:
+      state = self.streams.get(entry[1])
+      if state is not None:
+        state.prefetched.discard(key)
+
+  def _prefetch(self, id, key, state, block_no):
+    stride = state.stride
+    size = self.vfs.disk_metadata[id].size
+    if state.next is None or (state.next - block_no)*stride <= 0:
+      state.next = block_no + stride
+    end = block_no + stride*(state.window+1)
+    targets = []
+    while (end - state.next)*stride > 0 and 1 <= state.next <= size:
+      if (id, state.next) not in self.buffer:
+        targets.append(state.next)
+      state.next += stride
+    if not targets:
+      return
+    if stride == 1 and targets[-1] - targets[0] == len(targets) - 1:
+      block_info = bytearray(len(targets)*100)
+      sizes = self.vfs.read_blocks(id, targets[0], len(targets), block_info)
+      blocks = [bytes(block_info[i*100:i*100+n]) for i, n in enumerate(sizes)]
+    else:
+      blocks = []
+      for target in targets:
+        block_info = bytearray(100)
+        # Not through read_block(), prefetches are not client reads in the
+        # metrics and traces.
+        n = self.vfs._read_disk_block(id, target, block_info)
+        blocks.append(bytes(block_info[:max(n, 0)]))
+    for target, data in zip(targets, blocks):
+      self.buffer[(id, target)] = (data, key)
+      state.prefetched.add((id, target))
+    while len(self.buffer) > self.capacity:
+      old_key, (data, owner) = self.buffer.popitem(last=False)
+      state = self.streams.get(owner)
+      if state is not None and old_key in state.prefetched:
+        state.prefetched.discard(old_key)
+        state.window = max(self.min_window, state.window//2)
+
+def test_readahead():
+  from VFS3 import VFS
+  vfs = VFS(locality=True)
+  vfs.create_disk('A', 200)
+  for i in range(1, 201):
+    vfs.write_block('A', i, bytearray(('block ' + str(i)).encode()))
+  readahead = ReadAhead(vfs)
+  block_info = bytearray(100)
+  print('Sequential scan of Disk A')
+  for i in range(1, 201):
+    n = readahead.read_block('A', i, block_info)
+    assert block_info[:n].decode('utf-8') == 'block ' + str(i)
+  print(readahead.stats())
+  print('Strided scan of Disk A, every 3rd block')
+  for i in range(1, 201, 3):
+    n = readahead.read_block('A', i, block_info, stream='strided')
+    assert block_info[:n].decode('utf-8') == 'block ' + str(i)
+  print(readahead.stats())
+  print('Writing block 150 through read-ahead, then rereading it')
+  readahead.write_block('A', 150, bytearray(b'new'))
+  n = readahead.read_block('A', 150, block_info)
+  print(block_info[:n].decode('utf-8'))
+  print('Recreating Disk A, buffered blocks of the old disk are dropped')
+  readahead.delete_disk('A')
+  readahead.create_disk('A', 200)
+  n = readahead.read_block('A', 151, block_info)
+  print('Block 151 of the new Disk A has', n, 'bytes')
+
+if __name__ == '__main__':
+  test_readahead()
@@ -0,0 +1,260 @@
+"""
+I/O scheduler between the virtual disk API and the physical block calls
+of VFS3.
+Requests are queued per disk and dispatched in batches. Disks share the
+physical arrays by weighted fair queuing, and can be capped by token
+bucket IOPS and bandwidth limits. Within a batch requests are sorted by
+physical block (elevator order) and runs of adjacent blocks with the same
+op are issued as one _read_run/_write_run call.
+Completed requests are recorded in the metrics and tracer of the VFS as
+reads and writes, like direct read_block/write_block calls.
+"""
+from collections import deque
+import time
+
+from metrics import Histogram
+
+class TokenBucket:
+  def __init__(self, rate, burst=None, clock=time.perf_counter):
+    # The default burst is 100ms worth of tokens.
+    self.rate = rate
+    self.burst = burst if burst is not None else max(1, rate/10)
+    self.tokens = self.burst
+    self.clock = clock
+    self.last = clock()
+
+  def _refill(self):
+    now = self.clock()
+    self.tokens = min(self.burst, self.tokens + (now - self.last)*self.rate)
+    self.last = now
+
+  def available(self, amount):
+    # A request larger than the burst is let through once the bucket is
+    # full, the tokens then go negative and later requests wait for them.
+    self._refill()
+    return self.tokens >= min(amount, self.burst)
+
+  def take(self, amount):
+    self.tokens -= amount
+
+  def wait_time(self, amount):
+    # Seconds until 'amount' tokens are available.
+    self._refill()
+    return max(0.0, (min(amount, self.burst) - self.tokens)/self.rate)
+
+class Request:
+  def __init__(self, op, disk_id, block_no, block_info):
+    self.op = op
+    self.disk_id = disk_id
+    self.block_no = block_no
+    self.block_info = block_info
+    self.submitted = time.perf_counter()
+    # Weighted fair queuing finish tag, set on submit.
+    self.finish = 0.0
+    self.result = None
+    self.done = False
+
+class DiskQueue:
+  def __init__(self, weight=1, iops=None, bandwidth=None):
+    self.requests = deque()
+    self.weight = weight
+    self.iops = TokenBucket(iops) if iops else None
+    self.bandwidth = TokenBucket(bandwidth) if bandwidth else None
+    self.finish = 0.0
+    self.completed = 0
+    self.bytes = 0
+    self.latency = Histogram()
+
+  def admissible(self, request):
+    if self.iops is not None and not self.iops.available(1):
+      return False
+    if self.bandwidth is not None:
+      if not self.bandwidth.available(len(request.block_info)):
+        return False
+    return True
+
+  def charge(self, request):
+    if self.iops is not None:
+      self.iops.take(1)
+    if self.bandwidth is not None:
+      self.bandwidth.take(len(request.block_info))
+
+  def wait_time(self):
+    request = self.requests[0]
+    wait = 0.0
+    if self.iops is not None:
+      wait = max(wait, self.iops.wait_time(1))
+    if self.bandwidth is not None:
+      wait = max(wait, self.bandwidth.wait_time(len(request.block_info)))
+    return wait
+
+class IOScheduler:
+  def __init__(self, vfs, batch_size=32):
+    self.vfs = vfs
+    self.batch_size = batch_size
+    self.queues = {}
+    self.virtual_time = 0.0
+
+  def configure(self, disk_id, weight=1, iops=None, bandwidth=None):
+    # weight: share of the dispatch slots relative to other busy disks.
+    # iops: requests per second, bandwidth: bytes per second, None for
+    # no limit.
+    queue = self.queues.get(disk_id)
+    if queue is None:
+      queue = self.queues[disk_id] = DiskQueue()
+    queue.weight = weight
+    queue.iops = TokenBucket(iops) if iops else None
+    queue.bandwidth = TokenBucket(bandwidth) if bandwidth else None
+    return queue
+
+  def _submit(self, op, disk_id, block_no, block_info):
+    queue = self.queues.get(disk_id)
+    if queue is None:
+      queue = self.queues[disk_id] = DiskQueue()
+    request = Request(op, disk_id, block_no, block_info)
+    start = max(self.virtual_time, queue.finish)
+    request.finish = queue.finish = start + 1/queue.weight
+    queue.requests.append(request)
+    return request
+
+  def submit_read(self, disk_id, block_no, block_info):
+    return self._submit('read', disk_id, block_no, block_info)
+
+  def submit_write(self, disk_id, block_no, block_info):
+    return self._submit('write', disk_id, block_no, block_info)
+
+  def pending(self):
+    return sum(len(queue.requests) for queue in self.queues.values())
+
+  def _pick(self):
+    # Requests for the next batch: repeatedly the queue head with the
+    # smallest finish tag, skipping queues over their rate limits.
+    batch = []
+    while len(batch) < self.batch_size:
+      best = None
+      for queue in self.queues.values():
+        if not queue.requests:
+          continue
+        finish = queue.requests[0].finish
+        if best is not None and finish >= best.requests[0].finish:
+          continue
+        if queue.admissible(queue.requests[0]):
+          best = queue
+      if best is None:
+        break
+      request = best.requests.popleft()
+      best.charge(request)
+      self.virtual_time = request.finish
+      batch.append(request)
+    return batch
+
+  def _complete(self, request, result, pid=-1):
+    request.result = result
+    request.done = True
+    queue = self.queues[request.disk_id]
+    queue.completed += 1
+    nbytes = 0
+    if request.op == 'write' and result is True:
+      nbytes = len(request.block_info)
+    elif request.op == 'read' and result > 0:
+      nbytes = result
+    queue.bytes += nbytes
+    latency = time.perf_counter() - request.submitted
+    queue.latency.record(latency)
+    # Recorded like a read_block/write_block call of the VFS, with the
+    # latency including the time spent queued.
+    vfs = self.vfs
+    if vfs.metrics is not None:
+      ok = result is True if request.op == 'write' else result >= 0
+      vfs.metrics.record_op(request.op, request.disk_id, nbytes, ok, latency)
+    if vfs.tracer is not None:
+      vfs.tracer.emit(request.op, request.disk_id, request.block_no, pid,
+                      len(request.block_info), result, latency)
+
+  def dispatch(self):
+    # Runs one batch. Returns the number of requests completed.
+    batch = self._pick()
+    if not batch:
+      return 0
+    pending = []
+    for i, request in enumerate(batch):
+      # Mapped at dispatch time, the disk may have changed since submit.
+      pid = self.vfs._physical_block(request.disk_id, request.block_no)
+      if pid < 0:
+        self.vfs._log('Invalid disk id or block no')
+        self._complete(request, -1 if request.op == 'read' else False)
+      else:
+        pending.append((pid, i, request))
+    # Elevator order; ties keep submission order so a read after a write
+    # of the same block still sees the write.
+    pending.sort(key=lambda x: (x[0], x[1]))
+    run = []
+    for (pid, i, request) in pending:
+      if run and (run[-1][1].op != request.op or run[-1][0] + 1 != pid):
+        self._issue(run)
+        run = []
+      run.append((pid, request))
+    if run:
+      self._issue(run)
+    return len(batch)
+
+  def _issue(self, run):
+    block_no = run[0][0] + 1
+    block_infos = [request.block_info for (pid, request) in run]
+    if run[0][1].op == 'read':
+      results = self.vfs._read_run(block_no, block_infos)
+    else:
+      results = self.vfs._write_run(block_no, block_infos)
+    for (pid, request), result in zip(run, results):
+      self._complete(request, result, pid)
+
+  def run(self):
+    # Dispatches until every queue is empty, sleeping while all remaining
+    # requests are held back by their rate limits.
+    while self.pending():
+      if self.dispatch() == 0:
+        waits = [queue.wait_time() for queue in self.queues.values()
+                 if queue.requests]
+        time.sleep(min(waits))
+
+  def stats(self):
+    return {disk_id: {'weight': queue.weight, 'queued': len(queue.requests),
+                      'completed': queue.completed, 'bytes': queue.bytes,
+                      'latency': queue.latency.snapshot()}
+            for disk_id, queue in self.queues.items()}
+
+def test_scheduler():
+  from VFS3 import VFS
+  vfs = VFS(locality=True)
+  vfs.create_disk('A', 50)
+  vfs.create_disk('B', 50)
+  scheduler = IOScheduler(vfs, batch_size=16)
+  scheduler.configure('A', weight=3)
+  scheduler.configure('B', weight=1, iops=500)
+  for i in range(1, 51):
+    scheduler.submit_write('A', i, bytearray(b'a' + str(i).encode()))
+    scheduler.submit_write('B', i, bytearray(b'b' + str(i).encode()))
+  print('First batch, Disk A has 3 times the weight of Disk B')
+  scheduler.dispatch()
+  for disk_id, stats in scheduler.stats().items():
+    print(disk_id, 'completed', stats['completed'], 'queued', stats['queued'])
+  scheduler.run()
+  reads = [scheduler.submit_read('B', i, bytearray(10)) for i in range(1, 51)]
+  print('Disk B is limited to 500 IOPS')
+  start = time.perf_counter()
+  scheduler.run()
+  print('Read 50 blocks of Disk B in %.3fs' % (time.perf_counter() - start))
+  print('Block 7 of Disk B:', reads[6].block_info[:reads[6].result].decode('utf-8'))
+  print('Disk A is limited to 800 bytes/s, below one full block per burst')
+  scheduler.configure('A', bandwidth=800)
+  for i in range(1, 4):
+    scheduler.submit_write('A', i, bytearray(b'a'*100))
+  start = time.perf_counter()
+  scheduler.run()
+  print('Wrote 3 full blocks of Disk A in %.3fs' % (time.perf_counter() - start))
+  for disk_id, stats in scheduler.stats().items():
+    print(disk_id, stats['completed'], 'requests, p99 latency %.6fs'
+          % stats['latency']['p99'])
+
+if __name__ == '__main__':
+  test_scheduler()
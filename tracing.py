@@ -0,0 +1,166 @@
+"""
+Structured tracing of virtual disk operations, with record/replay.
+A VFS emits one event per API call to the tracer set by set_tracer():
+RingTracer keeps the last events in memory, FileTracer appends them to a
+compact binary trace file. replay() drives a VFS from recorded events,
+either as fast as possible or at the recorded timing.
+The error and status messages of a VFS become 'message' events while a
+tracer is set, and are only printed without one.
+"""
+from collections import deque, namedtuple
+import ast
+import struct
+import time
+
+# 'time' is when the call started, on the time.perf_counter() clock.
+# 'size' is the buffer length for read/write and the disk size for
+# create_disk/resize_disk. 'pid' is the physical block used, -1 if none.
+# 'message' is only set for 'message' events.
+Event = namedtuple('Event',
+                   'time op disk_id block_no pid size result duration message',
+                   defaults=('',))
+
+OPS = ('read', 'write', 'create_disk', 'delete_disk', 'checkpoint', 'message',
+       'resize_disk')
+_op_codes = {op: i for i, op in enumerate(OPS)}
+
+MAGIC = b'VFSTRACE1\n'
+# time, duration, op, result, block_no, pid, size, disk id type, id length.
+# The id (or the message text of a 'message' event) follows each record.
+_record = struct.Struct('<ddBiiiicH')
+
+def _result(op, result):
+  # read_block returns False on some errors, keep that apart from 0 bytes.
+  if op == 'read' and result is False:
+    return -1
+  return int(result)
+
+class RingTracer:
+  def __init__(self, capacity=65536):
+    self.events = deque(maxlen=capacity)
+
+  def emit(self, op, disk_id, block_no, pid, size, result, duration):
+    self.events.append(Event(time.perf_counter() - duration, op, disk_id,
+                             block_no, pid, size, _result(op, result),
+                             duration))
+
+  def message(self, text):
+    self.events.append(Event(time.perf_counter(), 'message', None, -1, -1, 0,
+                             0, 0.0, text))
+
+  def __iter__(self):
+    return iter(self.events)
+
+def _encode_id(disk_id):
+  # (kind, raw) that read_trace turns back into an equal id of the same
+  # type, None if there is none.
+  if isinstance(disk_id, str):
+    return b's', disk_id.encode()
+  if isinstance(disk_id, bool):
+    return b'b', str(disk_id).encode()
+  if isinstance(disk_id, int):
+    return b'i', str(disk_id).encode()
+  # Floats, tuples, None etc. are stored as literals.
+  text = repr(disk_id)
+  try:
+    if ast.literal_eval(text) == disk_id:
+      return b'r', text.encode()
+  except (ValueError, SyntaxError, TypeError):
+    pass
+  return None
+
+class FileTracer:
+  # Events that cannot be stored faithfully (an id without a literal form,
+  # values out of range) are counted in 'dropped' instead of raising, the
+  # traced call has already changed the VFS by then.
+  def __init__(self, path):
+    self.file = open(path, 'wb')
+    self.file.write(MAGIC)
+    self.dropped = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def close(self):
+    self.file.close()
+
+  def emit(self, op, disk_id, block_no, pid, size, result, duration):
+    # Disk ids keep their type, so replay targets the same disk.
+    encoded = _encode_id(disk_id)
+    if encoded is None:
+      self.dropped += 1
+      return
+    self._write(time.perf_counter() - duration, duration, op, result,
+                block_no, pid, size, encoded[0], encoded[1])
+
+  def message(self, text):
+    self._write(time.perf_counter(), 0.0, 'message', 0, -1, -1, 0, b'm',
+                text.encode(errors='replace'))
+
+  def _write(self, start, duration, op, result, block_no, pid, size, kind,
+             raw):
+    try:
+      record = _record.pack(start, duration, _op_codes[op], _result(op, result),
+                            block_no, pid, size, kind, len(raw))
+    except (struct.error, TypeError, ValueError):
+      self.dropped += 1
+      return
+    # One write per event, VFS4 writer threads may emit concurrently.
+    self.file.write(record + raw)
+
+def read_trace(path):
+  with open(path, 'rb') as f:
+    if f.read(len(MAGIC)) != MAGIC:
+      raise ValueError('Not a VFS trace file: %s' % path)
+    while True:
+      header = f.read(_record.size)
+      if len(header) < _record.size:
+        return
+      (start, duration, op, result, block_no, pid, size, kind,
+       length) = _record.unpack(header)
+      disk_id = f.read(length).decode()
+      message = ''
+      if kind == b'i':
+        disk_id = int(disk_id)
+      elif kind == b'b':
+        disk_id = disk_id == 'True'
+      elif kind == b'r':
+        disk_id = ast.literal_eval(disk_id)
+      elif kind == b'm':
+        disk_id, message = None, disk_id
+      yield Event(start, OPS[op], disk_id, block_no, pid, size, result,
+                  duration, message)
+
+def replay(vfs, events, timing=False):
+  # Re-issues 'events' against 'vfs'. Write payloads are not recorded, so
+  # writes replay zero filled buffers of the recorded size. 'message' events
+  # are skipped. Returns the number of events replayed and the elapsed time.
+  count = 0
+  first = None
+  start = time.perf_counter()
+  for event in events:
+    if event.op == 'message':
+      continue
+    if timing:
+      if first is None:
+        first = event.time
+      delay = (event.time - first) - (time.perf_counter() - start)
+      if delay > 0:
+        time.sleep(delay)
+    if event.op == 'read':
+      vfs.read_block(event.disk_id, event.block_no, bytearray(event.size))
+    elif event.op == 'write':
+      vfs.write_block(event.disk_id, event.block_no, bytearray(event.size))
+    elif event.op == 'create_disk':
+      vfs.create_disk(event.disk_id, event.size)
+    elif event.op == 'delete_disk':
+      vfs.delete_disk(event.disk_id)
+    elif event.op == 'resize_disk':
+      vfs.resize_disk(event.disk_id, event.size)
+    elif event.op == 'checkpoint':
+      vfs.create_checkpoint(event.disk_id)
+    count += 1
+  return count, time.perf_counter() - start